@@ -0,0 +1,246 @@
+# Офлайн-бенчмарк main.py: синтетичний трафік груп іде через dp.feed_update,
+# Telegram підмінено фейковою сесією, OpenAI — локальним мок-сервером із затримкою,
+# база — локальний Postgres (НЕ продакшн). Приклад:
+#   python bench.py --dsn postgresql://postgres@localhost/tgbot_bench --openai-latency 0.3
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import io
+import socket
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import asyncpg
+from aiohttp import web
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import EditMessageText, GetFile, GetMe, SendMessage
+
+BOT_ID = 42
+BENCH_CHATS = [-1009990000001, -1009990000002, -1009990000003, -1009990000004]
+BENCH_USERS = list(range(9990001, 9990041))
+
+BENCH_TABLES = ["msg_meta", "msg_txt", "photo", "here_ignore", "msg_daily_stats"]
+
+
+# --- ЛІЧИЛЬНИК ЗАПИТІВ ДО БАЗИ ---
+db_round_trips = 0
+
+def count_round_trips():
+    def wrap(cls, name):
+        orig = getattr(cls, name)
+        async def counted(self, *args, **kwargs):
+            global db_round_trips
+            db_round_trips += 1
+            return await orig(self, *args, **kwargs)
+        setattr(cls, name, counted)
+    for name in ("execute", "executemany", "fetch", "fetchrow", "fetchval", "copy_records_to_table"):
+        wrap(asyncpg.connection.Connection, name)
+    for name in ("start", "commit", "rollback"):
+        wrap(asyncpg.transaction.Transaction, name)
+
+
+# --- ФЕЙКОВИЙ TELEGRAM ---
+# Фото розміру найбільшого прев'ю Telegram, щоб зменшення в пулі процесів коштувало як у житті
+def bench_photo():
+    try: from PIL import Image
+    except ImportError: return b"\xff\xd8\xff\xd9"
+    out = io.BytesIO()
+    Image.effect_noise((1280, 960), 64).convert("RGB").save(out, "JPEG", quality=87)
+    return out.getvalue()
+
+class FakeSession(BaseSession):
+    def __init__(self):
+        super().__init__()
+        self.msg_ids = itertools.count(10_000_000)
+        self.calls = 0
+
+    def _message(self, bot, chat_id, message_id, text):
+        return SendMessage.__returning__.model_validate({
+            "message_id": message_id, "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup", "title": "bench"},
+            "from": {"id": BOT_ID, "is_bot": True, "first_name": "Bench", "username": "bench_bot"},
+            "text": text,
+        }, context={"bot": bot})
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls += 1
+        if isinstance(method, SendMessage): return self._message(bot, method.chat_id, next(self.msg_ids), method.text)
+        if isinstance(method, EditMessageText): return self._message(bot, method.chat_id, method.message_id, method.text)
+        if isinstance(method, GetFile): return GetFile.__returning__(file_id=method.file_id, file_unique_id=f"u_{method.file_id}", file_path=f"photos/{method.file_id}.jpg")
+        if isinstance(method, GetMe): return GetMe.__returning__(id=BOT_ID, is_bot=True, first_name="Bench")
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield bench_photo()
+
+    async def close(self): pass
+
+
+# --- МОК OPENAI ---
+def start_openai_mock(latency, reply_chars):
+    async def completions(request):
+        body = await request.json()
+        await asyncio.sleep(latency)
+        text = "Бенч-відповідь. " * (reply_chars // 16)
+        base = {"id": "bench", "created": int(time.time()), "model": body.get("model")}
+        if not body.get("stream"):
+            return web.json_response({**base, "object": "chat.completion",
+                                      "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                                      "usage": {"prompt_tokens": 100, "completion_tokens": len(text) // 3, "total_tokens": 100 + len(text) // 3}})
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await resp.prepare(request)
+        for i in range(0, len(text), 64):
+            chunk = {**base, "object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {"content": text[i:i + 64]}, "finish_reason": None}]}
+            await resp.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        await resp.write(b"data: [DONE]\n\n")
+        return resp
+
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", completions)
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    return app, sock
+
+
+# --- СИНТЕТИЧНИЙ ТРАФІК ---
+class Traffic:
+    def __init__(self, bot):
+        self.bot = bot
+        self.update_ids = itertools.count(1)
+        self.msg_ids = {chat_id: itertools.count(1) for chat_id in BENCH_CHATS}
+        self.recent = {chat_id: [] for chat_id in BENCH_CHATS}
+
+    def _user(self, uid):
+        return {"id": uid, "is_bot": False, "first_name": f"U{uid % 1000}", "username": f"bench_u{uid % 1000}"}
+
+    def message(self, chat_id=None, text=None, reply=False, photo=False, mention=False):
+        from aiogram import types
+        chat_id = chat_id or random.choice(BENCH_CHATS)
+        msg_id = next(self.msg_ids[chat_id])
+        msg = {"message_id": msg_id, "date": int(time.time()),
+               "chat": {"id": chat_id, "type": "supergroup", "title": f"bench {chat_id}"},
+               "from": self._user(random.choice(BENCH_USERS))}
+        if photo:
+            msg["photo"] = [{"file_id": f"p{chat_id}_{msg_id}", "file_unique_id": f"pu{chat_id}_{msg_id}", "width": 1280, "height": 960}]
+            msg["caption"] = text
+        else:
+            msg["text"] = text or f"повідомлення {msg_id} " + "бла " * random.randint(1, 40)
+        if mention:
+            name = f"@bench_u{random.choice(BENCH_USERS) % 1000}"
+            msg["text"] = f"{name} глянь сюди"
+            msg["entities"] = [{"type": "mention", "offset": 0, "length": len(name)}]
+        if reply and self.recent[chat_id]:
+            parent = random.choice(self.recent[chat_id][-50:])
+            msg["reply_to_message"] = {"message_id": parent, "date": int(time.time()), "chat": msg["chat"]}
+        self.recent[chat_id].append(msg_id)
+        return types.Update.model_validate({"update_id": next(self.update_ids), "message": msg}, context={"bot": self.bot})
+
+    def callback(self, data, chat_id=None):
+        from aiogram import types
+        chat_id = chat_id or random.choice(BENCH_CHATS)
+        user = self._user(random.choice(BENCH_USERS))
+        return types.Update.model_validate({"update_id": next(self.update_ids), "callback_query": {
+            "id": str(next(self.update_ids)), "from": user, "chat_instance": "bench", "data": data,
+            "message": {"message_id": 1, "date": int(time.time()), "chat": {"id": chat_id, "type": "supergroup"},
+                        "from": {"id": BOT_ID, "is_bot": True, "first_name": "Bench"}, "text": "menu"}}}, context={"bot": self.bot})
+
+    def group_traffic(self):
+        kind = random.random()
+        if kind < 0.6: return self.message()
+        if kind < 0.8: return self.message(reply=True)
+        if kind < 0.9: return self.message(photo=True)
+        return self.message(mention=True)
+
+
+# --- ПРОГІН ---
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+async def run_scenario(main, name, updates, concurrency):
+    global db_round_trips
+    await main.ingest.flush()
+    db_round_trips = 0
+    latencies, sem = [], asyncio.Semaphore(concurrency)
+
+    async def feed(update):
+        async with sem:
+            t = time.perf_counter()
+            await main.dp.feed_update(main.bot, update)
+            latencies.append(time.perf_counter() - t)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(feed(u) for u in updates))
+    await main.ingest.flush()
+    elapsed = time.perf_counter() - started
+    return {"scenario": name, "n": len(updates), "msg_s": len(updates) / elapsed,
+            "p50_ms": percentile(latencies, 0.5) * 1000, "p99_ms": percentile(latencies, 0.99) * 1000,
+            "db_rt_msg": db_round_trips / len(updates)}
+
+async def bench(args):
+    app, sock = start_openai_mock(args.openai_latency, args.reply_chars)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.SockSite(runner, sock).start()
+
+    os.environ.update({
+        "BOT_TOKEN": f"{BOT_ID}:BENCH", "NEON_URL": args.dsn,
+        "OPENAI_API_KEY": "bench", "OPENAI_BASE_URL": f"http://127.0.0.1:{sock.getsockname()[1]}/v1",
+        "IMAGE_CACHE_DIR": tempfile.mkdtemp(prefix="bench_images_"),
+    })
+    import main
+    # Лог кожного апдейту й HTTP-запиту спотворює заміри
+    logging.getLogger().setLevel(logging.WARNING)
+    main.bot.session = FakeSession()
+    # Фейковий Telegram без flood-лімітів: міряємо бота, а не паузи черги доставки
+    main.SEND_CHAT_INTERVAL, main.SEND_GROUP_PER_MINUTE, main.SEND_GLOBAL_RATE = 0.0, 10**6, 10**6
+    count_round_trips()
+
+    await main.create_pool()
+    await main.init_schema()
+    await main.ensure_indexes()
+    async with main.db_pool.acquire() as con:
+        for table in BENCH_TABLES: await con.execute(f"DELETE FROM {table} WHERE chat_id = ANY($1)", BENCH_CHATS)
+    main.ingest.start()
+
+    traffic = Traffic(main.bot)
+    # Прогрів: історія для реплаїв, ростерів і статистики
+    await run_scenario(main, "warmup", [traffic.group_traffic() for _ in range(args.warmup)], args.concurrency)
+
+    results = [
+        await run_scenario(main, "save_to_db", [traffic.group_traffic() for _ in range(args.messages)], args.concurrency),
+        await run_scenario(main, "cmd_gpt", [traffic.message(text="!розкажи щось", reply=True) for _ in range(args.gpt)], args.concurrency),
+        await run_scenario(main, "!stats", [traffic.callback(random.choice(["res_grp_all", "res_grp_1d", "list_usr_7d"])) for _ in range(args.commands)], args.concurrency),
+        await run_scenario(main, "!here", [traffic.message(text="!here") for _ in range(args.commands)], args.concurrency),
+    ]
+
+    await main.ingest.stop()
+    await main.db_pool.close()
+    await runner.cleanup()
+
+    print(f"{'scenario':<12}{'n':>7}{'msg/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'db rt/msg':>11}")
+    for r in results:
+        print(f"{r['scenario']:<12}{r['n']:>7}{r['msg_s']:>10.1f}{r['p50_ms']:>10.2f}{r['p99_ms']:>10.2f}{r['db_rt_msg']:>11.2f}")
+    print(f"Telegram API calls: {main.bot.session.calls}, {datetime.utcnow():%Y-%m-%d %H:%M} UTC")
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(description="Офлайн-бенчмарк бота")
+    p.add_argument("--dsn", default=os.getenv("BENCH_DSN"), help="локальний Postgres (BENCH_DSN)")
+    p.add_argument("--messages", type=int, default=2000)
+    p.add_argument("--gpt", type=int, default=100)
+    p.add_argument("--commands", type=int, default=200)
+    p.add_argument("--warmup", type=int, default=1000)
+    p.add_argument("--concurrency", type=int, default=50)
+    p.add_argument("--openai-latency", type=float, default=0.3)
+    p.add_argument("--reply-chars", type=int, default=600)
+    args = p.parse_args()
+    if not args.dsn:
+        print("❌ Вкажи --dsn або BENCH_DSN (локальна база, не продакшн)")
+        sys.exit(1)
+    asyncio.run(bench(args))
@@ -1,16 +1,35 @@
+import argparse
 import asyncio
+import base64
+import html
+import io
 import logging
+import multiprocessing
 import os
+import queue
+import signal
 import sys
 import asyncpg
 import random
+import re
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
 from datetime import datetime, timedelta
-from aiogram import Bot, Dispatcher, F, types
+from typing import NamedTuple, Optional
+from aiogram import BaseMiddleware, Bot, Dispatcher, F, types
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.types import CallbackQuery
+from aiohttp import web
 from dotenv import load_dotenv
-from openai import AsyncOpenAI
+from openai import APIConnectionError, AsyncOpenAI, InternalServerError, RateLimitError
+
+try: from PIL import Image
+except ImportError: Image = None  # зображення для GPT підуть без зменшення
 
 # --- КОНФІГУРАЦІЯ ---
 load_dotenv()
@@ -38,7 +57,8 @@ bot = Bot(token=API_TOKEN)
 dp = Dispatcher()
 db_pool = None
 
-gpt_client = AsyncOpenAI(api_key=OPENAI_API_KEY) if OPENAI_API_KEY else None
+# Повтори робить планувальник GPT, тому вбудовані в клієнт вимкнено
+gpt_client = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0) if OPENAI_API_KEY else None
 
 DEFAULT_SYSTEM_PROMPT = None 
 DEFAULT_TEMPERATURE = 1.0  
@@ -50,6 +70,191 @@ AVAILABLE_MODELS = [
     "gpt-5-pro"
 ]
 
+# --- КЕШІ ---
+class LRUCache:
+    # ttl=None — записи живуть до витіснення
+    def __init__(self, max_size, ttl=None):
+        self.max_size, self.ttl = max_size, ttl
+        self.data = OrderedDict()
+        self.hits = self.misses = 0
+
+    def _fresh(self, key):
+        item = self.data.get(key)
+        if item is None: return None
+        if self.ttl is not None and time.monotonic() - item[1] >= self.ttl:
+            del self.data[key]
+            return None
+        return item
+
+    def get(self, key, default=None):
+        item = self._fresh(key)
+        if item is None:
+            self.misses += 1
+            return default
+        self.data.move_to_end(key)
+        self.hits += 1
+        return item[0]
+
+    # Як get, але без лічильників і без зміни порядку
+    def peek(self, key, default=None):
+        item = self._fresh(key)
+        return default if item is None else item[0]
+
+    def put(self, key, value):
+        self.data[key] = (value, time.monotonic())
+        self.data.move_to_end(key)
+        while len(self.data) > self.max_size: self.data.popitem(last=False)
+
+    def pop(self, key):
+        item = self.data.pop(key, None)
+        return item[0] if item else None
+
+    def __contains__(self, key): return key in self.data
+
+    def stats(self):
+        total = self.hits + self.misses
+        return f"{len(self.data)}/{self.max_size}, hit {self.hits}, miss {self.misses} ({self.hits / total:.0%})" if total else f"{len(self.data)}/{self.max_size}"
+
+class ChatSettings(NamedTuple):
+    system_prompt: Optional[str]
+    temperature: Optional[float]
+    model_name: Optional[str]
+    memory: Optional[bool]
+
+# TTL потрібен, якщо налаштування може змінити інший інстанс бота
+SETTINGS_CACHE_SIZE = int(os.getenv("SETTINGS_CACHE_SIZE", "1024"))
+SETTINGS_CACHE_TTL = float(os.getenv("SETTINGS_CACHE_TTL", "300")) or None
+settings_cache = LRUCache(SETTINGS_CACHE_SIZE, SETTINGS_CACHE_TTL)
+
+# --- МЕТРИКИ ---
+# Гістограми затримок і лічильники гарячих шляхів: хендлери, SQL, очікування пулу, OpenAI,
+# Telegram. Віддаються в форматі Prometheus на METRICS_PORT і коротким звітом у !metrics.
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 — HTTP-ендпоінт вимкнено
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.sum, self.count = 0.0, 0
+        self.recent = deque(maxlen=1024)  # для p50/p99 у !metrics
+
+    def observe(self, value):
+        for i, le in enumerate(LATENCY_BUCKETS):
+            if value <= le: self.buckets[i] += 1; break
+        self.sum += value
+        self.count += 1
+        self.recent.append(value)
+
+    def quantile(self, q):
+        values = sorted(self.recent)
+        return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+class Metrics:
+    def __init__(self):
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.counters = {}  # (name, labels) -> float
+        self.gauges = {}  # (name, labels) -> callable
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        hist = self.histograms.get(key)
+        if hist is None: hist = self.histograms[key] = Histogram()
+        hist.observe(seconds)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, fn, **labels): self.gauges[(name, tuple(sorted(labels.items())))] = fn
+
+    def cache(self, name, cache):
+        self.gauge("bot_cache_hits", lambda: cache.hits, cache=name)
+        self.gauge("bot_cache_misses", lambda: cache.misses, cache=name)
+        self.gauge("bot_cache_size", lambda: len(cache.data), cache=name)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try: yield
+        finally: self.observe(name, time.perf_counter() - start, **labels)
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        items = [*labels, *extra]
+        if not items: return ""
+        esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in items) + "}"
+
+    def render(self):
+        out, typed = [], set()
+        def type_line(name, kind):
+            if name not in typed: typed.add(name); out.append(f"# TYPE {name} {kind}")
+        for (name, labels), hist in sorted(self.histograms.items()):
+            type_line(name, "histogram")
+            acc = 0
+            for le, n in zip(LATENCY_BUCKETS, hist.buckets):
+                acc += n
+                out.append(f"{name}_bucket{self._labels(labels, [('le', le)])} {acc}")
+            out.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {hist.count}")
+            out.append(f"{name}_sum{self._labels(labels)} {hist.sum}")
+            out.append(f"{name}_count{self._labels(labels)} {hist.count}")
+        for (name, labels), value in sorted(self.counters.items()):
+            type_line(name, "counter")
+            out.append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), fn in sorted(self.gauges.items(), key=lambda kv: kv[0]):
+            type_line(name, "gauge")
+            try: out.append(f"{name}{self._labels(labels)} {fn()}")
+            except Exception: pass
+        return "\n".join(out) + "\n"
+
+    # Найдорожчі серії за сумарним часом
+    def summary(self, limit=25):
+        rows = sorted(self.histograms.items(), key=lambda kv: kv[1].sum, reverse=True)[:limit]
+        return "\n".join(
+            f"{' '.join([name.removeprefix('bot_').removesuffix('_seconds'), *(str(v) for _, v in labels)])}: "
+            f"{h.count}× p50 {h.quantile(0.5) * 1000:.0f}ms p99 {h.quantile(0.99) * 1000:.0f}ms"
+            for (name, labels), h in rows)
+
+metrics = Metrics()
+metrics.cache("settings", settings_cache)
+
+# Час кожного хендлера (message і callback_query)
+class HandlerTimer(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        name = data["handler"].callback.__name__
+        start = time.perf_counter()
+        try: return await handler(event, data)
+        except Exception:
+            metrics.inc("bot_handler_errors_total", handler=name)
+            raise
+        finally: metrics.observe("bot_handler_seconds", time.perf_counter() - start, handler=name)
+
+# Час кожного запиту до Telegram Bot API
+class TelegramTimer(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        with metrics.timer("bot_telegram_seconds", method=type(method).__name__):
+            return await make_request(bot, method)
+
+def record_usage(model, usage):
+    if not usage: return
+    metrics.inc("bot_openai_tokens_total", usage.prompt_tokens or 0, model=model, kind="prompt")
+    metrics.inc("bot_openai_tokens_total", usage.completion_tokens or 0, model=model, kind="completion")
+
+async def start_metrics_server(port):
+    async def handle(request):
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", port).start()
+    logging.info(f"📈 Метрики на :{port}/metrics")
+    return runner
+
+dp.message.middleware(HandlerTimer())
+dp.callback_query.middleware(HandlerTimer())
+bot.session.middleware(TelegramTimer())
+
 # --- БАЗА ДАНИХ ---
 async def create_pool():
     global db_pool
@@ -60,75 +265,767 @@ async def create_pool():
         logging.error(f"❌ Не вдалося підключитися до бази: {e}")
         sys.exit(1)
 
-# --- ФУНКЦІЯ ЗАПИСУ ---
-async def save_to_db(message: types.Message):
-    user = message.from_user
-    chat = message.chat
-    if not user: return
+# Як db_pool.acquire(), але з заміром очікування вільного з'єднання;
+# з query — ще й часу роботи блоку як іменованого запиту
+@asynccontextmanager
+async def db_conn(query=None):
+    start = time.perf_counter()
+    async with db_pool.acquire() as con:
+        acquired = time.perf_counter()
+        metrics.observe("bot_db_acquire_seconds", acquired - start)
+        try: yield con
+        finally:
+            if query: metrics.observe("bot_sql_seconds", time.perf_counter() - acquired, query=query)
+
+# --- СХЕМА БАЗИ ---
+# Таблиці й індекси створюються/доганяються на старті. msg_meta і msg_txt на новій базі
+# партиціоновані по місяцях; стару непартиціоновану базу переносить `python main.py --migrate-schema`.
+MSG_PARTITIONS_AHEAD = 2  # скільки наступних місяців створювати наперед
+MSG_RETENTION_MONTHS = int(os.getenv("MSG_RETENTION_MONTHS", "0"))  # 0 — зберігати все
+MSG_RETENTION_MODE = os.getenv("MSG_RETENTION_MODE", "archive")  # archive — у схему archive, drop — видалити
+SCHEMA_MAINTENANCE_INTERVAL = 24 * 3600
+PARTITIONED_TABLES = ("msg_meta", "msg_txt")
+
+# Чи партиціоновані msg_meta/msg_txt: тоді в join по повідомленню додаємо date_msg для відсікання партицій
+msg_partitioned = False
+# Збережений tsvector є лише в партиціонованій msg_txt: на старій таблиці колонка переписала б її під локом
+msg_tsv = False
+# btree_gin дає GIN-індекс (chat_id, tsvector): пошук одразу звужується до чату
+fts_by_chat = False
+maintenance_task = None
+
+SCHEMA_SQL = """
+    CREATE TABLE IF NOT EXISTS users (
+        user_id BIGINT PRIMARY KEY,
+        username TEXT,
+        first_name TEXT,
+        last_name TEXT
+    );
+    ALTER TABLE users ADD COLUMN IF NOT EXISTS last_1000_analyze TIMESTAMP;
+
+    CREATE TABLE IF NOT EXISTS chats (
+        chat_id BIGINT PRIMARY KEY,
+        type TEXT,
+        title TEXT
+    );
+    ALTER TABLE chats ADD COLUMN IF NOT EXISTS system_prompt TEXT;
+    ALTER TABLE chats ADD COLUMN IF NOT EXISTS temperature DOUBLE PRECISION;
+    ALTER TABLE chats ADD COLUMN IF NOT EXISTS model_name TEXT;
+    ALTER TABLE chats ADD COLUMN IF NOT EXISTS memory BOOLEAN;
+
+    CREATE TABLE IF NOT EXISTS msg_meta (
+        chat_id BIGINT NOT NULL,
+        msg_id BIGINT NOT NULL,
+        user_id BIGINT,
+        date_msg TIMESTAMP NOT NULL,
+        msg_type TEXT,
+        reply_to BIGINT,
+        PRIMARY KEY (chat_id, msg_id, date_msg)
+    ) PARTITION BY RANGE (date_msg);
+
+    CREATE TABLE IF NOT EXISTS msg_txt (
+        chat_id BIGINT NOT NULL,
+        msg_id BIGINT NOT NULL,
+        date_msg TIMESTAMP NOT NULL,
+        msg_txt TEXT,
+        msg_tsv TSVECTOR GENERATED ALWAYS AS (to_tsvector('simple', coalesce(msg_txt, ''))) STORED,
+        PRIMARY KEY (chat_id, msg_id, date_msg)
+    ) PARTITION BY RANGE (date_msg);
+    -- Стара непартиціонована msg_txt не мала дати
+    ALTER TABLE msg_txt ADD COLUMN IF NOT EXISTS date_msg TIMESTAMP;
+
+    CREATE TABLE IF NOT EXISTS photo (
+        chat_id BIGINT NOT NULL,
+        msg_id BIGINT NOT NULL,
+        photo_url TEXT,
+        caption TEXT,
+        PRIMARY KEY (chat_id, msg_id)
+    );
+    -- photo_url зберігає file_id; file_unique_id — ключ кешу зменшених зображень
+    ALTER TABLE photo ADD COLUMN IF NOT EXISTS file_unique_id TEXT;
+
+    CREATE TABLE IF NOT EXISTS here_ignore (
+        chat_id BIGINT NOT NULL,
+        user_id BIGINT NOT NULL,
+        PRIMARY KEY (chat_id, user_id)
+    );
+
+    -- Денний ролап активності для !stats; наповнюється під час запису повідомлень
+    CREATE TABLE IF NOT EXISTS msg_daily_stats (
+        chat_id BIGINT NOT NULL,
+        user_id BIGINT NOT NULL,
+        day DATE NOT NULL,
+        msg_type TEXT NOT NULL,
+        cnt INTEGER NOT NULL,
+        PRIMARY KEY (chat_id, user_id, day, msg_type)
+    );
+"""
+
+# (таблиця, ім'я, колонки) — під запити аналізу, ростера і статистики
+SCHEMA_INDEXES = [
+    ("msg_meta", "msg_meta_chat_user_date_idx", "(chat_id, user_id, date_msg)"),
+    ("msg_meta", "msg_meta_chat_date_idx", "(chat_id, date_msg)"),
+    ("msg_daily_stats", "msg_daily_stats_chat_day_idx", "(chat_id, day)"),
+]
+
+# Повнотекстовий індекс msg_txt для !search і пам'яті GPT: (збережений tsvector, btree_gin) -> (ім'я, колонки).
+# Вираз має збігатися з fts_document()
+FTS_INDEXES = {
+    (True, True): ("msg_txt_chat_tsv_idx", "USING gin (chat_id, msg_tsv)"),
+    (True, False): ("msg_txt_tsv_idx", "USING gin (msg_tsv)"),
+    (False, True): ("msg_txt_chat_fts_idx", "USING gin (chat_id, to_tsvector('simple', msg_txt))"),
+    (False, False): ("msg_txt_fts_idx", "USING gin (to_tsvector('simple', msg_txt))"),
+}
+
+def schema_indexes():
+    return SCHEMA_INDEXES + [("msg_txt", *FTS_INDEXES[(msg_tsv, fts_by_chat)])]
+
+def month_start(d): return d.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+def add_months(d, n):
+    y, m = divmod(d.month - 1 + n, 12)
+    return d.replace(year=d.year + y, month=m + 1, day=1)
+
+# Join повідомлення з msg_txt; на партиціонованих таблицях дата дозволяє не обходити всі партиції
+def txt_join(m, t):
+    return f"{m}.chat_id = {t}.chat_id AND {m}.msg_id = {t}.msg_id" + (f" AND {m}.date_msg = {t}.date_msg" if msg_partitioned else "")
+
+# 'r' — звичайна таблиця, 'p' — партиціонована, None — немає. Тип "char" asyncpg віддав би як bytes
+async def relkind(con, table):
+    return await con.fetchval("SELECT c.relkind::text FROM pg_class c WHERE c.oid = to_regclass($1)", table)
+
+# Усі DDL під advisory-локом: воркери webhook-режиму стартують одночасно
+async def schema_lock(con):
+    await con.execute("SELECT pg_advisory_xact_lock(hashtext('tgbot_schema'))")
+
+async def ensure_partitions(con, table, since):
+    await con.execute(f"CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT")
+    start, last = month_start(since), add_months(month_start(datetime.utcnow()), MSG_PARTITIONS_AHEAD)
+    while start <= last:
+        end = add_months(start, 1)
+        await con.execute(f"CREATE TABLE IF NOT EXISTS {table}_{start:%Y_%m} PARTITION OF {table} FOR VALUES FROM ('{start:%Y-%m-%d}') TO ('{end:%Y-%m-%d}')")
+        start = end
+
+# Партиції, старші за MSG_RETENTION_MONTHS, від'єднуються і переносяться в archive (або видаляються)
+async def apply_retention(con):
+    if not MSG_RETENTION_MONTHS: return
+    cutoff = add_months(month_start(datetime.utcnow()), -MSG_RETENTION_MONTHS)
+    rows = await con.fetch("""
+        SELECT c.relname, p.relname AS parent FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent
+        WHERE p.relname = ANY($1::text[])
+    """, list(PARTITIONED_TABLES))
+    for r in rows:
+        m = re.fullmatch(rf"{r['parent']}_(\d{{4}})_(\d{{2}})", r['relname'])
+        if not m or add_months(datetime(int(m[1]), int(m[2]), 1), 1) > cutoff: continue
+        await con.execute(f"ALTER TABLE {r['parent']} DETACH PARTITION {r['relname']}")
+        if MSG_RETENTION_MODE == "drop":
+            await con.execute(f"DROP TABLE {r['relname']}")
+        else:
+            await con.execute("CREATE SCHEMA IF NOT EXISTS archive")
+            await con.execute(f"ALTER TABLE {r['relname']} SET SCHEMA archive")
+        logging.info(f"🗃 Партицію {r['relname']} {'видалено' if MSG_RETENTION_MODE == 'drop' else 'перенесено в archive'}")
+
+async def maintain_partitions(con):
+    async with con.transaction():
+        await schema_lock(con)
+        for table in PARTITIONED_TABLES:
+            if await relkind(con, table) == 'p': await ensure_partitions(con, table, datetime.utcnow())
+        await apply_retention(con)
+
+async def init_schema():
+    global msg_partitioned, msg_tsv, fts_by_chat
+    async with db_conn() as con:
+        async with con.transaction():
+            await schema_lock(con)
+            await con.execute(SCHEMA_SQL)
+            if await relkind(con, "msg_txt") == 'p':
+                await con.execute("ALTER TABLE msg_txt ADD COLUMN IF NOT EXISTS msg_tsv TSVECTOR GENERATED ALWAYS AS (to_tsvector('simple', coalesce(msg_txt, ''))) STORED")
+            try:
+                async with con.transaction(): await con.execute("CREATE EXTENSION IF NOT EXISTS btree_gin")
+            except asyncpg.PostgresError as e: logging.info(f"btree_gin недоступний, пошук без індексу по чату: {e}")
+        kinds = {table: await relkind(con, table) for table in PARTITIONED_TABLES}
+        msg_partitioned = all(k == 'p' for k in kinds.values())
+        if not msg_partitioned: logging.warning("⚠️ msg_meta/msg_txt не партиціоновані — запусти main.py --migrate-schema")
+        msg_tsv = bool(await con.fetchval("SELECT 1 FROM pg_attribute WHERE attrelid = to_regclass('msg_txt') AND attname = 'msg_tsv' AND NOT attisdropped"))
+        fts_by_chat = bool(await con.fetchval("SELECT 1 FROM pg_extension WHERE extname = 'btree_gin'"))
+        await maintain_partitions(con)
+
+async def index_valid(con, name):
+    return await con.fetchval("SELECT i.indisvalid FROM pg_index i WHERE i.indexrelid = to_regclass($1)", name)
+
+# CONCURRENTLY не блокує запис. Перерваний CONCURRENTLY лишає INVALID-індекс, який IF NOT EXISTS
+# пропустив би назавжди, тож такий індекс перебудовується
+async def build_index_concurrently(con, name, table, cols):
+    valid = await index_valid(con, name)
+    if valid: return False
+    if valid is False: await con.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+    await con.execute(f"CREATE INDEX CONCURRENTLY {name} ON {table} {cols}")
+    return True
 
+# На партиціонованій таблиці CONCURRENTLY недоступний: порожній індекс ON ONLY на батьківській,
+# CONCURRENTLY на кожній партиції, потім ATTACH. Нові партиції отримують індекс автоматично
+async def build_partitioned_index(con, name, table, cols):
+    if await index_valid(con, name): return False
+    await con.execute(f"CREATE INDEX IF NOT EXISTS {name} ON ONLY {table} {cols}")
+    parts = await con.fetch("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = to_regclass($1)", table)
+    for r in parts:
+        # Партиції, створені вже після індексу, отримали свій індекс від Postgres під іншим ім'ям
+        attached = await con.fetchval("""
+            SELECT 1 FROM pg_inherits i JOIN pg_index x ON x.indexrelid = i.inhrelid
+            WHERE i.inhparent = to_regclass($1) AND x.indrelid = to_regclass($2)
+        """, name, r['relname'])
+        if attached: continue
+        child = f"{r['relname']}_{name[len(table) + 1:]}"
+        await build_index_concurrently(con, child, r['relname'], cols)
+        await con.execute(f"ALTER INDEX {name} ATTACH PARTITION {child}")
+    return True
+
+# Індекси будуються у фоні після старту: на десятках мільйонів рядків це хвилини.
+# Будує один процес — решта воркерів пропускають, поки тримається advisory-лок
+async def ensure_indexes():
+    async with db_conn() as con:
+        if not await con.fetchval("SELECT pg_try_advisory_lock(hashtext('tgbot_indexes'))"): return
+        try:
+            for table, name, cols in schema_indexes():
+                build = build_partitioned_index if await relkind(con, table) == 'p' else build_index_concurrently
+                start = time.monotonic()
+                if await build(con, name, table, cols): logging.info(f"🗂 Індекс {name} побудовано за {time.monotonic() - start:.0f}с")
+            # Повнотекстові індекси попередніх варіантів прибираються лише після того, як новий готовий
+            current = FTS_INDEXES[(msg_tsv, fts_by_chat)][0]
+            for name, _ in FTS_INDEXES.values():
+                if name == current or await index_valid(con, name) is None: continue
+                await con.execute(f"DROP INDEX {'CONCURRENTLY ' if await relkind(con, 'msg_txt') == 'r' else ''}IF EXISTS {name}")
+        finally: await con.execute("SELECT pg_advisory_unlock(hashtext('tgbot_indexes'))")
+
+async def schema_maintenance():
+    while True:
+        # Окремо: помилка побудови індексу не повинна зупиняти створення партицій і retention
+        try:
+            async with db_conn() as con: await maintain_partitions(con)
+        except Exception as e: logging.error(f"Partition maintenance error: {e}")
+        try: await ensure_indexes()
+        except Exception as e: logging.error(f"Index build error: {e}")
+        await asyncio.sleep(SCHEMA_MAINTENANCE_INTERVAL)
+
+# Разовий перенос старих msg_meta/msg_txt у партиціоновані таблиці (бот має бути зупинений).
+# Старі таблиці лишаються як *_legacy, їх можна видалити після перевірки.
+async def migrate_schema():
+    await create_pool()
     try:
-        async with db_pool.acquire() as con:
-            await con.execute("""
-                INSERT INTO users (user_id, username, first_name, last_name)
-                VALUES ($1, $2, $3, $4)
-                ON CONFLICT (user_id) DO UPDATE 
-                SET username = EXCLUDED.username, first_name = EXCLUDED.first_name, last_name = EXCLUDED.last_name
-            """, user.id, user.username, user.first_name, user.last_name)
-
-            await con.execute("""
-                INSERT INTO chats (chat_id, type, title)
-                VALUES ($1, $2, $3)
-                ON CONFLICT (chat_id) DO UPDATE SET type = EXCLUDED.type, title = EXCLUDED.title
-            """, chat.id, chat.type, chat.title)
-
-            msg_date = message.date.replace(tzinfo=None)
-            reply_to = message.reply_to_message.message_id if message.reply_to_message else None
-            
-            msg_type = 'text'
-            if message.photo: msg_type = 'photo'
-            elif message.sticker: msg_type = 'sticker'
-
-            await con.execute("""
-                INSERT INTO msg_meta (chat_id, msg_id, user_id, date_msg, msg_type, reply_to)
-                VALUES ($1, $2, $3, $4, $5, $6)
-                ON CONFLICT (chat_id, msg_id) DO NOTHING
-            """, chat.id, message.message_id, user.id, msg_date, msg_type, reply_to)
-
-            if message.text:
-                await con.execute("""
-                    INSERT INTO msg_txt (chat_id, msg_id, msg_txt)
-                    VALUES ($1, $2, $3)
-                    ON CONFLICT (chat_id, msg_id) DO NOTHING
-                """, chat.id, message.message_id, message.text)
-            elif message.photo:
-                photo = message.photo[-1]
-                await con.execute("""
-                    INSERT INTO photo (chat_id, msg_id, photo_url, caption)
-                    VALUES ($1, $2, $3, $4)
-                    ON CONFLICT (chat_id, msg_id) DO NOTHING
-                """, chat.id, message.message_id, photo.file_id, message.caption)
+        async with db_conn() as con:
+            async with con.transaction():
+                await schema_lock(con)
+                kinds = [await relkind(con, t) for t in PARTITIONED_TABLES]
+                if all(k in ('p', None) for k in kinds):
+                    print("✅ Вже партиціоновано."); return
+                await con.execute("ALTER TABLE msg_txt ADD COLUMN IF NOT EXISTS date_msg TIMESTAMP")
+                for table in PARTITIONED_TABLES: await con.execute(f"ALTER TABLE {table} RENAME TO {table}_legacy")
+                # Імена індексів унікальні в схемі — звільняємо їх для нових таблиць
+                for name in ["msg_meta_pkey", "msg_txt_pkey"] + [i[1] for i in SCHEMA_INDEXES if i[0] in PARTITIONED_TABLES] + [n for n, _ in FTS_INDEXES.values()]:
+                    await con.execute(f"ALTER INDEX IF EXISTS {name} RENAME TO {name.replace('msg_', 'msg_legacy_', 1)}")
+                await con.execute(SCHEMA_SQL)
+                since = await con.fetchval("SELECT MIN(date_msg) FROM msg_meta_legacy") or datetime.utcnow()
+                for table in PARTITIONED_TABLES: await ensure_partitions(con, table, since)
+                n = await con.execute("INSERT INTO msg_meta SELECT chat_id, msg_id, user_id, date_msg, msg_type, reply_to FROM msg_meta_legacy WHERE date_msg IS NOT NULL ON CONFLICT DO NOTHING")
+                t = await con.execute("""
+                    INSERT INTO msg_txt (chat_id, msg_id, date_msg, msg_txt)
+                    SELECT t.chat_id, t.msg_id, m.date_msg, t.msg_txt FROM msg_txt_legacy t
+                    JOIN msg_meta_legacy m ON m.chat_id = t.chat_id AND m.msg_id = t.msg_id
+                    WHERE m.date_msg IS NOT NULL ON CONFLICT DO NOTHING
+                """)
+            print(f"✅ Перенесено: msg_meta {n.split()[-1]}, msg_txt {t.split()[-1]}")
+        await init_schema()
+        await ensure_indexes()
+    finally: await db_pool.close()
+
+# --- ЧЕРГА ЗАПИСУ (WRITE-BEHIND) ---
+# Хендлери не чекають на базу: рядки збираються в пам'яті і пишуться пачками
+# (executemany в одній транзакції) кожні INGEST_FLUSH_MS мс або по INGEST_BATCH_ROWS рядків.
+INGEST_FLUSH_MS = int(os.getenv("INGEST_FLUSH_MS", "250"))
+INGEST_BATCH_ROWS = int(os.getenv("INGEST_BATCH_ROWS", "200"))
+# Обрив з'єднання чи перевантаження бази: пачка повторюється, а потім повертається в чергу,
+# поки в пам'яті не більше INGEST_MAX_PENDING повідомлень
+INGEST_RETRY_ATTEMPTS = 3
+INGEST_MAX_PENDING = int(os.getenv("INGEST_MAX_PENDING", "20000"))
+INGEST_TRANSIENT = (OSError, asyncio.TimeoutError, asyncpg.PostgresConnectionError,
+                    asyncpg.exceptions.InsufficientResourcesError, asyncpg.exceptions.OperatorInterventionError,
+                    asyncpg.exceptions.TransactionRollbackError)
+
+def is_transient(e):
+    # Клієнтський DataError теж InterfaceError, але повтор його не виправить
+    return isinstance(e, INGEST_TRANSIENT) or (isinstance(e, asyncpg.InterfaceError) and not isinstance(e, ValueError))
+
+# Останній записаний стан users/chats: upsert іде лише коли він змінився (або запис витіснено)
+UPSERT_CACHE_SIZE = int(os.getenv("UPSERT_CACHE_SIZE", "10000"))
+written_users = LRUCache(UPSERT_CACHE_SIZE)
+written_chats = LRUCache(UPSERT_CACHE_SIZE)
+metrics.cache("users_upsert", written_users)
+metrics.cache("chats_upsert", written_chats)
+
+SQL_UPSERT_USER = """
+    INSERT INTO users (user_id, username, first_name, last_name)
+    VALUES ($1, $2, $3, $4)
+    ON CONFLICT (user_id) DO UPDATE 
+    SET username = EXCLUDED.username, first_name = EXCLUDED.first_name, last_name = EXCLUDED.last_name
+"""
+SQL_UPSERT_CHAT = """
+    INSERT INTO chats (chat_id, type, title)
+    VALUES ($1, $2, $3)
+    ON CONFLICT (chat_id) DO UPDATE SET type = EXCLUDED.type, title = EXCLUDED.title
+"""
+# Ролап рахує лише реально вставлені рядки, тож повторний запис того ж повідомлення його не роздуває
+SQL_INSERT_META = """
+    WITH ins AS (
+        INSERT INTO msg_meta (chat_id, msg_id, user_id, date_msg, msg_type, reply_to)
+        SELECT * FROM unnest($1::bigint[], $2::bigint[], $3::bigint[], $4::timestamp[], $5::text[], $6::bigint[])
+        ON CONFLICT DO NOTHING
+        RETURNING chat_id, user_id, date_msg, msg_type
+    )
+    INSERT INTO msg_daily_stats (chat_id, user_id, day, msg_type, cnt)
+    SELECT chat_id, user_id, date_msg::date, msg_type, COUNT(*) FROM ins GROUP BY 1, 2, 3, 4
+    ON CONFLICT (chat_id, user_id, day, msg_type) DO UPDATE SET cnt = msg_daily_stats.cnt + EXCLUDED.cnt
+"""
+SQL_INSERT_TXT = """
+    INSERT INTO msg_txt (chat_id, msg_id, date_msg, msg_txt)
+    VALUES ($1, $2, $3, $4)
+    ON CONFLICT DO NOTHING
+"""
+SQL_INSERT_PHOTO = """
+    INSERT INTO photo (chat_id, msg_id, photo_url, file_unique_id, caption)
+    VALUES ($1, $2, $3, $4, $5)
+    ON CONFLICT (chat_id, msg_id) DO NOTHING
+"""
+
+class IngestQueue:
+    def __init__(self, flush_ms, batch_rows):
+        self.flush_interval = flush_ms / 1000
+        self.batch_rows = batch_rows
+        self.lock = asyncio.Lock()
+        self.wake = asyncio.Event()
+        self.task = None
+        self._reset()
+
+    def _reset(self):
+        # users/chats — словники, щоб у пачці був лише останній стан кожного рядка
+        self.users, self.chats = {}, {}
+        self.meta, self.txt, self.photo = [], [], []
+
+    def pending(self):
+        return len(self.users) + len(self.chats) + len(self.meta) + len(self.txt) + len(self.photo)
+
+    def put(self, message: types.Message):
+        user, chat = message.from_user, message.chat
+        user_fp, chat_fp = (user.username, user.first_name, user.last_name), (chat.type, chat.title)
+        if written_users.get(user.id) != user_fp: self.users[user.id] = (user.id, *user_fp)
+        if written_chats.get(chat.id) != chat_fp: self.chats[chat.id] = (chat.id, *chat_fp)
+
+        msg_date = message.date.replace(tzinfo=None)
+        reply_to = message.reply_to_message.message_id if message.reply_to_message else None
+
+        msg_type = 'text'
+        if message.photo: msg_type = 'photo'
+        elif message.sticker: msg_type = 'sticker'
+
+        self.meta.append((chat.id, message.message_id, user.id, msg_date, msg_type, reply_to))
+        if message.text:
+            self.txt.append((chat.id, message.message_id, msg_date, message.text))
+        elif message.photo:
+            self.photo.append((chat.id, message.message_id, message.photo[-1].file_id, message.photo[-1].file_unique_id, message.caption))
+
+        if self.pending() >= self.batch_rows: self.wake.set()
+
+    async def _write(self, users, chats, meta, txt, photo, query="ingest_flush"):
+        async with db_conn(query) as con:
+            async with con.transaction():
+                if users: await con.executemany(SQL_UPSERT_USER, users)
+                if chats: await con.executemany(SQL_UPSERT_CHAT, chats)
+                if meta: await con.execute(SQL_INSERT_META, *map(list, zip(*meta)))
+                if txt: await con.executemany(SQL_INSERT_TXT, txt)
+                if photo: await con.executemany(SQL_INSERT_PHOTO, photo)
+        # Відбиток запам'ятовуємо лише після коміту
+        for uid, *fp in users: written_users.put(uid, tuple(fp))
+        for cid, *fp in chats: written_chats.put(cid, tuple(fp))
+
+    # Помилка даних у пачці: кожен рядок users/chats і кожне повідомлення окремою транзакцією,
+    # щоб втратити лише зламані. Повертає кількість втрачених повідомлень
+    async def _write_each(self, users, chats, meta, txt, photo):
+        for user in users:
+            try: await self._write([user], [], [], [], [], "ingest_row")
+            except Exception as e: logging.error(f"Save DB Error: {e} (user {user[0]})")
+        for chat in chats:
+            try: await self._write([], [chat], [], [], [], "ingest_row")
+            except Exception as e: logging.error(f"Save DB Error: {e} (chat {chat[0]})")
+        txt_by_msg, photo_by_msg = {r[:2]: r for r in txt}, {r[:2]: r for r in photo}
+        dropped = 0
+        for row in meta:
+            key = row[:2]
+            try: await self._write([], [], [row], [txt_by_msg[key]] if key in txt_by_msg else [], [photo_by_msg[key]] if key in photo_by_msg else [], "ingest_row")
+            except Exception as e:
+                logging.error(f"Save DB Error: {e} (повідомлення {key[0]}/{key[1]})")
+                dropped += 1
+        return dropped
+
+    def _requeue(self, users, chats, meta, txt, photo):
+        # Новіший стан users/chats, що прийшов за час спроб, має перевагу
+        self.users = {r[0]: r for r in users} | self.users
+        self.chats = {r[0]: r for r in chats} | self.chats
+        self.meta, self.txt, self.photo = meta + self.meta, txt + self.txt, photo + self.photo
+
+    async def flush(self):
+        # Лок тримається до коміту: хто чекає на flush(), далі бачить усі рядки в базі
+        async with self.lock:
+            if not self.pending(): return
+            batch = list(self.users.values()), list(self.chats.values()), self.meta, self.txt, self.photo
+            meta = batch[2]
+            self._reset()
+            for attempt in range(INGEST_RETRY_ATTEMPTS + 1):
+                try:
+                    await self._write(*batch)
+                    metrics.inc("bot_ingest_rows_total", len(meta))
+                    return
+                except Exception as e:
+                    if not is_transient(e): err = e; break
+                    logging.warning(f"Save DB Error: {e} (спроба {attempt + 1})")
+                    metrics.inc("bot_ingest_retries_total")
+                    if attempt < INGEST_RETRY_ATTEMPTS: await asyncio.sleep(0.5 * 2 ** attempt)
+            else:
+                if len(meta) + len(self.meta) <= INGEST_MAX_PENDING:
+                    self._requeue(*batch)
+                    return
+                logging.error(f"Save DB Error: база недоступна, черга переповнена (втрачено повідомлень: {len(meta)})")
+                metrics.inc("bot_ingest_dropped_total", len(meta))
+                return
+            logging.error(f"Save DB Error: {err} — пишу пачку по рядку")
+            dropped = await self._write_each(*batch)
+            metrics.inc("bot_ingest_rows_total", len(meta) - dropped)
+            if dropped: metrics.inc("bot_ingest_dropped_total", dropped)
+
+    async def _run(self):
+        while True:
+            try: await asyncio.wait_for(self.wake.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError: pass
+            self.wake.clear()
+            await self.flush()
+
+    def start(self):
+        if not self.task: self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try: await self.task
+            except asyncio.CancelledError: pass
+            self.task = None
+        await self.flush()
+
+ingest = IngestQueue(INGEST_FLUSH_MS, INGEST_BATCH_ROWS)
+metrics.gauge("bot_ingest_pending", ingest.pending)
+
+# --- ІНДЕКС РЕПЛАЇВ ---
+# Свіжі повідомлення кожного чату в пам'яті: ланцюжок реплаїв для GPT збирається без
+# рекурсивного запиту, а в базу йдемо лише коли ланка вже випала з буфера.
+REPLY_INDEX_PER_CHAT = int(os.getenv("REPLY_INDEX_PER_CHAT", "2000"))
+REPLY_INDEX_CHATS = int(os.getenv("REPLY_INDEX_CHATS", "256"))
+
+class ThreadNode(NamedTuple):
+    msg_id: int
+    reply_to: Optional[int]
+    user_id: int
+    date_msg: datetime
+    msg_txt: Optional[str]
+    file_id: Optional[str]
+    first_name: Optional[str]
+    file_unique_id: Optional[str]
+
+class ReplyIndex:
+    def __init__(self, per_chat, max_chats):
+        self.per_chat = per_chat
+        self.chats = LRUCache(max_chats)
+
+    def add(self, message: types.Message):
+        buf = self.chats.peek(message.chat.id)
+        if buf is None: buf = OrderedDict()
+        self.chats.put(message.chat.id, buf)
+        buf[message.message_id] = ThreadNode(
+            message.message_id,
+            message.reply_to_message.message_id if message.reply_to_message else None,
+            message.from_user.id,
+            message.date.replace(tzinfo=None),
+            message.text,
+            message.photo[-1].file_id if message.photo and not message.text else None,
+            message.from_user.first_name,
+            message.photo[-1].file_unique_id if message.photo and not message.text else None,
+        )
+        while len(buf) > self.per_chat: buf.popitem(last=False)
 
+    # Повертає (ланки від нової до старої, msg_id ланки, якої нема в буфері, або None)
+    def walk(self, chat_id, start_msg_id, depth):
+        buf = self.chats.get(chat_id) or {}
+        chain, cur = [], start_msg_id
+        while cur is not None and len(chain) < depth:
+            node = buf.get(cur)
+            if node is None: return chain, cur
+            chain.append(node)
+            cur = node.reply_to
+        return chain, None
+
+reply_index = ReplyIndex(REPLY_INDEX_PER_CHAT, REPLY_INDEX_CHATS)
+
+# --- РОСТЕР ЧАТУ ---
+# Учасники чату, username → user_id і here_ignore в пам'яті: !here, !roulette і перевірка згадок
+# не ходять у базу. Ростер читається з бази один раз, далі його оновлюють save_to_db і !ignorehere.
+ROSTER_CHATS = int(os.getenv("ROSTER_CHATS", "512"))
+
+class ChatRoster:
+    def __init__(self):
+        self.members = {}  # user_id -> (username, first_name)
+        self.by_username = {}  # username.lower() -> user_id
+        self.ignored = set()
+        # Учасники поза ігнором: список + позиції, щоб і вибір, і видалення були O(1)
+        self.active, self.pos = [], {}
+        self.loaded = False
+        self.lock = asyncio.Lock()
+
+    def _activate(self, uid):
+        if uid in self.pos or uid in self.ignored or uid not in self.members: return
+        self.pos[uid] = len(self.active)
+        self.active.append(uid)
+
+    def _deactivate(self, uid):
+        i = self.pos.pop(uid, None)
+        if i is None: return
+        last = self.active.pop()
+        if last != uid: self.active[i] = last; self.pos[last] = i
+
+    def seen(self, uid, username, first_name):
+        old = self.members.get(uid)
+        if old and old[0] and self.by_username.get(old[0].lower()) == uid: del self.by_username[old[0].lower()]
+        self.members[uid] = (username, first_name)
+        if username: self.by_username[username.lower()] = uid
+        self._activate(uid)
+
+    def set_ignored(self, uid, ignored):
+        if ignored: self.ignored.add(uid); self._deactivate(uid)
+        else: self.ignored.discard(uid); self._activate(uid)
+
+    def is_ignored(self, uid=None, username=None):
+        if username is not None: uid = self.by_username.get(username.lower())
+        return uid in self.ignored
+
+    def listed(self): return [(uid, *self.members[uid]) for uid in self.active]
+
+    def pick(self):
+        if not self.active: return None
+        uid = random.choice(self.active)
+        return (uid, *self.members[uid])
+
+rosters = LRUCache(ROSTER_CHATS)
+
+def get_roster(chat_id) -> ChatRoster:
+    roster = rosters.peek(chat_id)
+    if roster is None: roster = ChatRoster()
+    rosters.put(chat_id, roster)
+    return roster
+
+async def load_roster(chat_id) -> ChatRoster:
+    roster = get_roster(chat_id)
+    if roster.loaded: return roster
+    async with roster.lock:
+        if roster.loaded: return roster
+        async with db_conn("roster_load") as con:
+            members = await con.fetch("SELECT DISTINCT u.user_id, u.username, u.first_name FROM users u JOIN msg_meta m ON u.user_id=m.user_id WHERE m.chat_id=$1", chat_id)
+            ignored = await con.fetch("SELECT user_id FROM here_ignore WHERE chat_id=$1", chat_id)
+        for r in ignored: roster.set_ignored(r['user_id'], True)
+        # Те, що вже прийшло з інджесту, свіжіше за базу
+        for r in members:
+            if r['user_id'] not in roster.members: roster.seen(r['user_id'], r['username'], r['first_name'])
+        roster.loaded = True
+    return roster
+
+# --- ФУНКЦІЯ ЗАПИСУ ---
+# flush=True — дочекатися запису в базу (для команд, що одразу читають/оновлюють ці рядки)
+async def save_to_db(message: types.Message, flush: bool = False):
+    if not message.from_user: return
+    try:
+        ingest.put(message)
+        reply_index.add(message)
+        get_roster(message.chat.id).seen(message.from_user.id, message.from_user.username, message.from_user.first_name)
     except Exception as e:
         logging.error(f"Save DB Error: {e}")
+        return
+    if flush: await ingest.flush()
+
+# --- НАЛАШТУВАННЯ ЧАТУ ---
+async def get_chat_settings(chat_id) -> ChatSettings:
+    cached = settings_cache.get(chat_id)
+    if cached is not None: return cached
+    async with db_conn("chat_settings") as con:
+        row = await con.fetchrow("SELECT system_prompt, temperature, model_name, memory FROM chats WHERE chat_id=$1", chat_id)
+    cur = ChatSettings(row['system_prompt'], row['temperature'], row['model_name'], row['memory']) if row else ChatSettings(None, None, None, None)
+    settings_cache.put(chat_id, cur)
+    return cur
+
+# Write-through: спершу база, потім кеш
+async def update_chat_settings(chat_id, **changes):
+    cols = ", ".join(f"{k}=${i + 2}" for i, k in enumerate(changes))
+    async with db_conn() as con: await con.execute(f"UPDATE chats SET {cols} WHERE chat_id=$1", chat_id, *changes.values())
+    cached = settings_cache.peek(chat_id)
+    if cached is not None: settings_cache.put(chat_id, cached._replace(**changes))
+
+# --- ПЛАНУВАЛЬНИК GPT ---
+# Усі виклики OpenAI проходять через слоти: загальний ліміт, окремий ліміт на модель,
+# справедлива черга по колу між чатами і обмежена черга для кожного чату.
+GPT_MAX_CONCURRENCY = int(os.getenv("GPT_MAX_CONCURRENCY", "8"))
+GPT_MODEL_CONCURRENCY = {"gpt-5-pro": int(os.getenv("GPT_PRO_CONCURRENCY", "2"))}
+GPT_CHAT_QUEUE_LIMIT = int(os.getenv("GPT_CHAT_QUEUE_LIMIT", "5"))
+GPT_RETRY_ATTEMPTS = int(os.getenv("GPT_RETRY_ATTEMPTS", "3"))
+GPT_RETRYABLE = (RateLimitError, APIConnectionError, InternalServerError)
+
+class GptQueueFull(Exception): pass
+
+# "1s", "6m0s", "250ms" з x-ratelimit-reset-* → секунди
+def parse_reset(value):
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", value or "")
+    return sum(float(n) * units[u] for n, u in parts) if parts else None
+
+def retry_delay(e, attempt):
+    delay = None
+    headers = getattr(getattr(e, "response", None), "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"): delay = float(headers["retry-after-ms"]) / 1000
+        elif headers.get("retry-after"): delay = float(headers["retry-after"])
+    except ValueError: pass
+    if delay is None:
+        resets = [parse_reset(headers.get(h)) for h in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens")]
+        delay = max([r for r in resets if r is not None], default=None)
+    if delay is None: delay = 2 ** attempt
+    # Джитер, щоб чати, які впали одночасно, не повторювали теж одночасно
+    return min(delay, 60) * random.uniform(1, 1.5)
+
+class GptScheduler:
+    def __init__(self, max_running, model_limits, chat_queue_limit):
+        self.max_running = max_running
+        self.model_limits = model_limits
+        self.chat_queue_limit = chat_queue_limit
+        self.queues = OrderedDict()  # chat_id -> deque[(model, future)], порядок = черга обходу
+        self.running = 0
+        self.running_by_model = {}
+        self.served = self.queued_total = self.rejected = self.retried = 0
+
+    def depth(self): return sum(len(q) for q in self.queues.values())
+
+    def _has_room(self, model):
+        return self.running < self.max_running and self.running_by_model.get(model, 0) < self.model_limits.get(model, self.max_running)
+
+    def _release(self, model):
+        self.running -= 1
+        self.running_by_model[model] -= 1
+        self._pump()
+
+    def _pump(self):
+        progressed = True
+        while progressed and self.running < self.max_running:
+            progressed = False
+            for chat_id in list(self.queues):
+                q = self.queues[chat_id]
+                model, fut = q[0]
+                if not fut.done() and not self._has_room(model): continue
+                q.popleft()
+                if q: self.queues.move_to_end(chat_id)
+                else: del self.queues[chat_id]
+                if fut.done(): continue  # той, хто чекав, уже скасований
+                self.running += 1
+                self.running_by_model[model] = self.running_by_model.get(model, 0) + 1
+                self.served += 1
+                fut.set_result(None)
+                progressed = True
+
+    # on_queued(позиція в черзі свого чату) викликається, якщо запит не стартував одразу.
+    # Між чатами черга йде по колу, тож порядок визначають лише запити того самого чату
+    @asynccontextmanager
+    async def slot(self, chat_id, model, on_queued=None, limit=True):
+        q = self.queues.get(chat_id)
+        if limit and q is not None and len(q) >= self.chat_queue_limit:
+            self.rejected += 1
+            raise GptQueueFull()
+        fut = asyncio.get_running_loop().create_future()
+        self.queues.setdefault(chat_id, deque()).append((model, fut))
+        self._pump()
+        try:
+            if not fut.done():
+                self.queued_total += 1
+                if on_queued:
+                    # Сповіщення про чергу не критичне: його помилка не повинна забрати слот
+                    try: await on_queued(self.queues[chat_id].index((model, fut)) + 1)
+                    except Exception as e: logging.warning(f"GPT queue notice failed: {e}")
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled(): self._release(model)
+            elif (q := self.queues.get(chat_id)) and (model, fut) in q:
+                q.remove((model, fut))
+                if not q: del self.queues[chat_id]
+            raise
+        try: yield
+        finally: self._release(model)
+
+    # Повтор на 429 і тимчасових помилках з паузою за заголовками rate limit
+    async def call(self, model, factory):
+        for attempt in range(GPT_RETRY_ATTEMPTS + 1):
+            start = time.perf_counter()
+            try:
+                result = await factory()
+                metrics.observe("bot_openai_seconds", time.perf_counter() - start, model=model)
+                record_usage(model, getattr(result, "usage", None))
+                return result
+            except GPT_RETRYABLE as e:
+                metrics.inc("bot_openai_errors_total", model=model, error=type(e).__name__)
+                if attempt == GPT_RETRY_ATTEMPTS: raise
+                self.retried += 1
+                delay = retry_delay(e, attempt)
+                logging.warning(f"OpenAI {type(e).__name__}, повтор через {delay:.1f}с")
+                await asyncio.sleep(delay)
+
+    def stats(self):
+        models = ", ".join(f"{m}: {n}" for m, n in self.running_by_model.items() if n) or "—"
+        return (f"виконується {self.running}/{self.max_running} ({models}), у черзі {self.depth()} (чатів {len(self.queues)}), "
+                f"виконано {self.served}, чекали {self.queued_total}, відхилено {self.rejected}, повторів {self.retried}")
+
+gpt_scheduler = GptScheduler(GPT_MAX_CONCURRENCY, GPT_MODEL_CONCURRENCY, GPT_CHAT_QUEUE_LIMIT)
+metrics.gauge("bot_gpt_running", lambda: gpt_scheduler.running)
+metrics.gauge("bot_gpt_queue_depth", gpt_scheduler.depth)
+metrics.gauge("bot_gpt_queued_chats", lambda: len(gpt_scheduler.queues))
 
 # --- ЛОГІКА ІСТОРІЇ (РЕКУРСИВНІ РЕПЛАЇ) ---
 async def get_thread_context(chat_id, start_msg_id):
-    async with db_pool.acquire() as con:
-        sql = """
+    chain, missing = reply_index.walk(chat_id, start_msg_id, THREAD_DEPTH_LIMIT)
+    rows = [node._asdict() for node in chain]
+    metrics.inc("bot_thread_context_total", source="memory" if missing is None else "db")
+    if missing is not None:
+        rows += await get_thread_context_db(chat_id, missing, THREAD_DEPTH_LIMIT - len(chain))
+    rows.sort(key=lambda r: r['date_msg'])
+    return rows
+
+async def get_thread_context_db(chat_id, start_msg_id, depth):
+    # Ланка могла ще стояти в черзі запису
+    await ingest.flush()
+    async with db_conn("thread_context") as con:
+        sql = f"""
             WITH RECURSIVE thread AS (
                 SELECT m.msg_id, m.reply_to, m.user_id, m.date_msg, 
-                       t.msg_txt, p.photo_url as file_id, 1 as depth
+                       t.msg_txt, p.photo_url as file_id, p.file_unique_id, 1 as depth
                 FROM msg_meta m
-                LEFT JOIN msg_txt t ON m.chat_id = t.chat_id AND m.msg_id = t.msg_id
+                LEFT JOIN msg_txt t ON {txt_join("m", "t")}
                 LEFT JOIN photo p ON m.chat_id = p.chat_id AND m.msg_id = p.msg_id
                 WHERE m.chat_id = $1 AND m.msg_id = $2
 
                 UNION ALL
 
                 SELECT parent.msg_id, parent.reply_to, parent.user_id, parent.date_msg, 
-                       pt.msg_txt, pp.photo_url as file_id, thread.depth + 1
+                       pt.msg_txt, pp.photo_url as file_id, pp.file_unique_id, thread.depth + 1
                 FROM msg_meta parent
-                LEFT JOIN msg_txt pt ON parent.chat_id = pt.chat_id AND parent.msg_id = pt.msg_id
+                LEFT JOIN msg_txt pt ON {txt_join("parent", "pt")}
                 LEFT JOIN photo pp ON parent.chat_id = pp.chat_id AND parent.msg_id = pp.msg_id
                 JOIN thread ON thread.reply_to = parent.msg_id
                 WHERE parent.chat_id = $1 AND thread.depth < $3
@@ -138,17 +1035,231 @@ async def get_thread_context(chat_id, start_msg_id):
             LEFT JOIN users u ON thread.user_id = u.user_id
             ORDER BY thread.date_msg ASC;
         """
-        rows = await con.fetch(sql, chat_id, start_msg_id, THREAD_DEPTH_LIMIT)
-        return rows
+        rows = await con.fetch(sql, chat_id, start_msg_id, depth)
+        return [dict(r) for r in rows]
 
-# --- ХЕЛПЕРИ ---
-async def get_image_url(file_id):
-    try:
-        file = await bot.get_file(file_id)
-        return f"https://api.telegram.org/file/bot{API_TOKEN}/{file.file_path}"
+# --- ПОШУК ---
+# Пошук іде через GIN-індекс з FTS_INDEXES. Конфігурація 'simple': української в Postgres
+# немає, тож слова порівнюються без стемінгу.
+SEARCH_PAGE_SIZE = 5
+SEARCH_CANDIDATES = 1000  # скільки збігів максимум ранжується; решта не читається
+SEARCH_SNIPPET = 200
+MEMORY_DEFAULT = os.getenv("GPT_MEMORY", "0") == "1"  # для чатів, де !memory не вмикали/вимикали
+MEMORY_TOP_K = int(os.getenv("GPT_MEMORY_TOP_K", "8"))
+MEMORY_TOKEN_BUDGET = 1500
+MEMORY_MIN_WORD = 3  # коротші слова ('simple' без стоп-слів) збігаються майже з усім
+MEMORY_MAX_WORDS = 16
+
+# !search: лапки, OR і мінус як у вебпошуку; пам'ять GPT: будь-яке зі слів, ранг вищий за більше збігів
+SEARCH_TSQUERY = "websearch_to_tsquery('simple', $2)"
+MEMORY_TSQUERY = "to_tsquery('simple', replace(plainto_tsquery('simple', $2)::text, ' & ', ' | '))"
+
+def fts_document(alias): return f"{alias}.msg_tsv" if msg_tsv else f"to_tsvector('simple', {alias}.msg_txt)"
+
+# exclude — msg_id, які вже є в контексті. Кандидати беруться з індексу з лімітом, і ранг
+# рахується лише для них, тож часті слова не перетворюють запит на обхід усього чату
+async def search_messages(chat_id, tsquery, text, limit, offset=0, exclude=(), name="search"):
+    doc = fts_document("t")
+    sql = f"""
+        WITH hits AS MATERIALIZED (
+            SELECT t.chat_id, t.msg_id, t.date_msg, t.msg_txt, ts_rank({doc}, {tsquery}) AS rank
+            FROM msg_txt t
+            WHERE t.chat_id = $1 AND {doc} @@ {tsquery} AND NOT (t.msg_id = ANY($5::bigint[]))
+            LIMIT {SEARCH_CANDIDATES}
+        )
+        SELECT m.msg_id, m.date_msg, t.msg_txt, u.first_name
+        FROM hits t
+        JOIN msg_meta m ON {txt_join("m", "t")}
+        LEFT JOIN users u ON u.user_id = m.user_id
+        ORDER BY t.rank DESC, m.date_msg DESC
+        LIMIT $3 OFFSET $4
+    """
+    async with db_conn(name) as con: return await con.fetch(sql, chat_id, text, limit, offset, list(exclude))
+
+# Старі повідомлення чату, схожі на запит, у межах MEMORY_TOKEN_BUDGET — блок для системного промпту
+async def recall_messages(chat_id, prompt, exclude):
+    words = list(dict.fromkeys(w for w in re.findall(r"\w+", prompt.lower()) if len(w) >= MEMORY_MIN_WORD))[:MEMORY_MAX_WORDS]
+    if not words: return None
+    rows = await search_messages(chat_id, MEMORY_TSQUERY, " ".join(words), MEMORY_TOP_K, exclude=exclude, name="memory")
+    lines, budget = [], MEMORY_TOKEN_BUDGET
+    for r in sorted(rows, key=lambda r: r['date_msg']):
+        line = f"[{r['date_msg']:%Y-%m-%d}] {r['first_name'] or '?'}: {r['msg_txt']}"
+        if (cost := estimate_tokens(line)) > budget: continue
+        lines.append(line); budget -= cost
+    return "Можливо доречні старі повідомлення з цього чату:\n" + "\n".join(lines) if lines else None
+
+# --- ФАЙЛИ TELEGRAM ---
+# Посилання на файл живе щонайменше годину, тому шлях кешуємо трохи менше
+FILE_PATH_TTL = float(os.getenv("FILE_PATH_TTL", "3000"))
+FILE_RESOLVE_CONCURRENCY = int(os.getenv("FILE_RESOLVE_CONCURRENCY", "8"))
+file_path_cache = LRUCache(4096, FILE_PATH_TTL)
+file_path_inflight = {}
+metrics.cache("file_path", file_path_cache)
+file_resolve_sem = asyncio.Semaphore(FILE_RESOLVE_CONCURRENCY)
+
+# Один запит на ключ: паралельні виклики чекають на той самий future
+async def single_flight(inflight, key, factory):
+    fut = inflight.get(key)
+    if fut is None:
+        fut = inflight[key] = asyncio.ensure_future(factory())
+        fut.add_done_callback(lambda _: inflight.pop(key, None))
+    return await asyncio.shield(fut)
+
+async def get_file_path(file_id):
+    path = file_path_cache.get(file_id)
+    if path: return path
+    async def fetch():
+        async with file_resolve_sem:
+            with metrics.timer("bot_file_resolve_seconds"): file = await bot.get_file(file_id)
+        file_path_cache.put(file_id, file.file_path)
+        return file.file_path
+    return await single_flight(file_path_inflight, file_id, fetch)
+
+# --- ЗОБРАЖЕННЯ ---
+# Фото для GPT завантажується один раз, зменшується в пулі процесів до розміру під модель і
+# кешується на диску за file_unique_id. В OpenAI іде data URL: модель не тягне файл сама,
+# а токен бота не потрапляє в посилання. Без Pillow фото йде в оригінальному розмірі.
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", "image_cache")
+IMAGE_CACHE_MB = int(os.getenv("IMAGE_CACHE_MB", "256"))
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+IMAGE_QUALITY = 80
+# Довша сторона після зменшення. 512px — один тайл (255 токенів), 1024px — чотири (765).
+# Більше 1024 для 4:3 не дає деталей: OpenAI однаково зводить коротшу сторону до 768
+MODEL_IMAGE_SIDE = {
+    "gpt-5-mini": 512,
+    "gpt-5.2-chat-latest": 1024,
+    "gpt-5-pro": 1024,
+}
+DEFAULT_IMAGE_SIDE = 1024
+
+# Вартість фото в токенах за правилами high detail для кадру 4:3 (вписати в 2048, коротша сторона до 768, тайли 512px)
+def image_tokens(model):
+    w = MODEL_IMAGE_SIDE.get(model, DEFAULT_IMAGE_SIDE); h = w * 3 // 4
+    if w > 2048: w, h = 2048, 1536
+    if h > 768: w, h = w * 768 // h, 768
+    return 85 + 170 * -(-w // 512) * -(-h // 512)
+
+# Виконується в процесі пулу
+def shrink_image(data, side, quality):
+    with Image.open(io.BytesIO(data)) as img:
+        img.thumbnail((side, side))
+        out = io.BytesIO()
+        img.convert("RGB").save(out, "JPEG", quality=quality, optimize=True)
+        return out.getvalue()
+
+# LRU на диску з лімітом за сумарним розміром; порядок відновлюється з mtime після рестарту
+class DiskCache:
+    def __init__(self, path, max_bytes):
+        self.path, self.max_bytes = path, max_bytes
+        self.data = OrderedDict()  # ключ -> розмір файлу
+        self.size = self.hits = self.misses = 0
+        self.loading = None
+
+    def _file(self, key): return os.path.join(self.path, f"{key}.jpg")
+
+    def _load(self):
+        os.makedirs(self.path, exist_ok=True)
+        entries = [e for e in os.scandir(self.path) if e.is_file() and e.name.endswith(".jpg")]
+        return [(e.name[:-4], e.stat().st_size) for e in sorted(entries, key=lambda e: e.stat().st_mtime)]
+
+    # self.data і self.size змінюються лише в event loop; у потоці — тільки файли
+    def _victims(self):
+        victims = []
+        while self.size > self.max_bytes and self.data:
+            key, size = self.data.popitem(last=False)
+            self.size -= size
+            victims.append(key)
+        return victims
+
+    def _remove(self, keys):
+        for key in keys:
+            try: os.remove(self._file(key))
+            except FileNotFoundError: pass
+
+    def _read(self, key):
+        with open(self._file(key), "rb") as f: data = f.read()
+        os.utime(self._file(key))
+        return data
+
+    def _write(self, key, data):
+        tmp = self._file(key) + ".tmp"
+        with open(tmp, "wb") as f: f.write(data)
+        os.replace(tmp, self._file(key))
+
+    # Каталог сканується один раз, навіть якщо перші запити прийшли паралельно
+    async def _ready(self):
+        if self.loading is None: self.loading = asyncio.ensure_future(self._scan())
+        await self.loading
+
+    async def _scan(self):
+        for key, size in await asyncio.to_thread(self._load):
+            self.data[key] = size
+            self.size += size
+        await asyncio.to_thread(self._remove, self._victims())
+
+    async def get(self, key):
+        await self._ready()
+        if key not in self.data: self.misses += 1; return None
+        try: data = await asyncio.to_thread(self._read, key)
+        except FileNotFoundError:
+            self.size -= self.data.pop(key, 0); self.misses += 1; return None
+        # Поки файл читався, ключ могли витіснити
+        if key in self.data: self.data.move_to_end(key)
+        self.hits += 1
+        return data
+
+    async def put(self, key, data):
+        await self._ready()
+        await asyncio.to_thread(self._write, key, data)
+        self.size += len(data) - self.data.pop(key, 0)
+        self.data[key] = len(data)
+        if victims := self._victims(): await asyncio.to_thread(self._remove, victims)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return f"{len(self.data)} файлів, {self.size / 2**20:.1f}/{self.max_bytes / 2**20:.0f} МБ" + (f", hit {self.hits}, miss {self.misses} ({self.hits / total:.0%})" if total else "")
+
+image_cache = DiskCache(IMAGE_CACHE_DIR, IMAGE_CACHE_MB * 2**20)
+metrics.cache("image", image_cache)
+image_inflight = {}
+image_pool = None
+
+def get_image_pool():
+    global image_pool
+    # spawn, як і воркери webhook: fork процесу з event loop і потоками ненадійний
+    if image_pool is None: image_pool = ProcessPoolExecutor(IMAGE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return image_pool
+
+async def prepare_image(file_id, key, side):
+    data = await image_cache.get(key)
+    if data is not None: return data
+    path = await get_file_path(file_id)
+    with metrics.timer("bot_image_download_seconds"): data = (await bot.download_file(path)).getvalue()
+    if Image is not None:
+        with metrics.timer("bot_image_shrink_seconds"):
+            data = await asyncio.get_running_loop().run_in_executor(get_image_pool(), shrink_image, data, side, IMAGE_QUALITY)
+    await image_cache.put(key, data)
+    return data
+
+# photo — (file_id, file_unique_id); старі записи без file_unique_id кешуються за file_id
+async def get_image_url(photo, model):
+    file_id, unique_id = photo
+    side = MODEL_IMAGE_SIDE.get(model, DEFAULT_IMAGE_SIDE)
+    key = f"{unique_id or file_id}_{side}"
+    try: data = await single_flight(image_inflight, key, lambda: prepare_image(file_id, key, side))
     except Exception as e:
-        logging.error(f"Error getting file url: {e}")
+        logging.error(f"Error preparing image: {e}")
         return None
+    return "data:image/jpeg;base64," + base64.b64encode(data).decode()
+
+# Усі фото треду готуються паралельно: {photo: data URL або None}
+async def get_image_urls(photos, model):
+    photos = list(dict.fromkeys(p for p in photos if p))
+    return dict(zip(photos, await asyncio.gather(*(get_image_url(p, model) for p in photos))))
+
+# --- ХЕЛПЕРИ ---
+# Груба локальна оцінка: ~3 символи на токен для змішаного кириличного й латинського тексту
+def estimate_tokens(text): return len(text) // 3 + 1 if text else 0
 
 async def check_for_sleeping_uzbeks(message: types.Message):
     if not message.entities: return
@@ -158,36 +1269,279 @@ async def check_for_sleeping_uzbeks(message: types.Message):
         if entity.type == 'text_mention': mentioned_ids.append(entity.user.id)
         elif entity.type == 'mention': mentioned_usernames.append(message.text[entity.offset + 1 : entity.offset + entity.length])
     if not mentioned_ids and not mentioned_usernames: return
-    chat_id = message.chat.id
     try:
-        async with db_pool.acquire() as con:
-            exists = await con.fetchval("SELECT 1 FROM here_ignore hi LEFT JOIN users u ON hi.user_id = u.user_id WHERE hi.chat_id = $1 AND (hi.user_id = ANY($2) OR u.username = ANY($3)) LIMIT 1", chat_id, mentioned_ids, mentioned_usernames)
-            if exists: await message.reply("ЧШШШШ УЗБЕКІ СПЯТЬ")
+        roster = await load_roster(message.chat.id)
+        if any(roster.is_ignored(uid=u) for u in mentioned_ids) or any(roster.is_ignored(username=u) for u in mentioned_usernames):
+            await message.reply("ЧШШШШ УЗБЕКІ СПЯТЬ")
     except: pass
 
+# --- ДОСТАВКА ВІДПОВІДЕЙ ---
+# Markdown від GPT перетворюється на entities локально: Telegram не відхиляє розмітку, і кожен шматок
+# коштує один запит. Довгий текст ріжеться по абзацах і блоках коду, а надсилання йде через
+# чергу з лімітами Telegram на чат і на бота та з повтором після retry_after.
+MESSAGE_LIMIT = 4000  # у UTF-16 одиницях, із запасом до 4096
+SEND_CHAT_INTERVAL = 1.0  # не частіше повідомлення на секунду в чат
+SEND_GROUP_PER_MINUTE = 20
+SEND_GLOBAL_RATE = 30  # повідомлень на секунду на весь бот
+SEND_RETRY_ATTEMPTS = 3
+SEND_STATE_CHATS = 4096
+
+def utf16_len(s): return len(s.encode("utf-16-le")) // 2
+
+FENCE_RE = re.compile(r"^```.*?(?:^```[ \t]*$|\Z)", re.M | re.S)
+HEADING_RE = re.compile(r"^#{1,6}[ \t]+(.+?)[ \t#]*$", re.M)
+MD_INLINE = re.compile(
+    r"`(?P<code>[^`\n]+)`"
+    r"|\[(?P<label>[^\]\n]+)\]\((?P<url>https?://[^)\s]+)\)"
+    r"|\*\*\*(?P<bolditalic>[^\s*](?:.*?[^\s*])?)\*\*\*"
+    r"|\*\*(?P<bold>.+?)\*\*|__(?P<bold2>.+?)__"
+    r"|~~(?P<strike>.+?)~~"
+    r"|(?<![\w*])\*(?P<italic>[^\s*](?:.*?[^\s*])?)\*(?![\w*])"
+    r"|(?<![\w_])_(?P<italic2>[^\s_](?:.*?[^\s_])?)_(?![\w_])"
+)
+
+class MarkdownText:
+    def __init__(self): self.parts, self.size, self.entities = [], 0, []
+
+    def add(self, s): self.parts.append(s); self.size += utf16_len(s)
+
+    def wrap(self, kind, fill, **extra):
+        start = self.size
+        fill()
+        if self.size > start: self.entities.append(types.MessageEntity(type=kind, offset=start, length=self.size - start, **extra))
+
+    def inline(self, text):
+        pos = 0
+        for m in MD_INLINE.finditer(text):
+            self.add(text[pos:m.start()]); pos = m.end()
+            g = m.groupdict()
+            if g['code'] is not None: self.wrap("code", lambda: self.add(g['code']))
+            elif g['url']: self.wrap("text_link", lambda: self.inline(g['label']), url=g['url'])
+            elif g['bolditalic'] is not None: self.wrap("bold", lambda: self.wrap("italic", lambda: self.inline(g['bolditalic'])))
+            else:
+                kind, inner = next((k, v) for k, v in (("bold", g['bold']), ("bold", g['bold2']), ("strikethrough", g['strike']), ("italic", g['italic']), ("italic", g['italic2'])) if v is not None)
+                self.wrap(kind, lambda: self.inline(inner))
+        self.add(text[pos:])
+
+    def block(self, text):
+        self.inline(HEADING_RE.sub(lambda m: f"**{m[1].replace('**', '')}**", text))
+
+# Непарні маркери лишаються текстом. Повертає (текст, entities)
+def render_markdown(text):
+    out, pos = MarkdownText(), 0
+    for m in FENCE_RE.finditer(text):
+        out.block(text[pos:m.start()]); pos = m.end()
+        lines = m.group().split("\n")
+        closed = len(lines) > 1 and lines[-1].startswith("```")
+        out.wrap("pre", lambda: out.add("\n".join(lines[1:-1] if closed else lines[1:])), language=lines[0][3:].strip() or None)
+    out.block(text[pos:])
+    plain = "".join(out.parts)
+    return (plain, out.entities) if plain.strip() else (text, [])
+
+def utf16_cut(s, limit):
+    size = 0
+    for i, ch in enumerate(s):
+        size += 2 if ord(ch) > 0xFFFF else 1
+        if size > limit: return i
+    return len(s)
+
+# Жадібно складає шматки в повідомлення; одиницю, довшу за ліміт, ріже по пробілу або жорстко
+def pack(units, limit):
+    out, cur = [], ""
+    for u in units:
+        if cur and utf16_len(cur + u) > limit: out.append(cur); cur = ""
+        while utf16_len(u) > limit:
+            cut = utf16_cut(u, limit)
+            cut = u.rfind(" ", 0, cut) + 1 or cut
+            out.append(u[:cut]); u = u[cut:]
+        cur += u
+    return out + [cur] if cur else out
+
+# Ріже Markdown по абзацах і межах блоків коду; блок коду, довший за ліміт, ділиться по рядках
+# і закривається/відкривається заново в кожному шматку. strip=False лишає шматки як є (для стрімінгу)
+def split_markdown(text, limit=MESSAGE_LIMIT, strip=True):
+    units, pos = [], 0
+    def paragraphs(s): units.extend(p for p in re.split(r"(?<=\n\n)", s) if p)
+    for m in FENCE_RE.finditer(text):
+        paragraphs(text[pos:m.start()]); pos = m.end()
+        fence = m.group()
+        if utf16_len(fence) <= limit: units.append(fence); continue
+        lines = fence.split("\n")
+        body = lines[1:-1] if len(lines) > 1 and lines[-1].startswith("```") else lines[1:]
+        head = lines[0] + "\n"
+        units += [head + part + "```" for part in pack([line + "\n" for line in body], limit - utf16_len(head) - 3)]
+    paragraphs(text[pos:])
+    split = []
+    for unit in units: split += [unit] if utf16_len(unit) <= limit else unit.splitlines(keepends=True)
+    pieces = pack(split, limit)
+    return [p.strip() for p in pieces if p.strip()] if strip else pieces
+
+class ChatPace(NamedTuple):
+    lock: asyncio.Lock
+    sent: deque  # час останніх SEND_GROUP_PER_MINUTE надсилань
+    until: list  # [час, до якого чат на паузі після retry_after]
+
+# Запити в чат виконуються по черзі (asyncio.Lock віддає чергу в порядку очікування) з паузами
+# за лімітами. call — фабрика корутини, як у GptScheduler.call
+class SendQueue:
+    def __init__(self):
+        self.chats = LRUCache(SEND_STATE_CHATS)
+        self.global_next = 0.0
+        self.pending = self.sent_total = self.retry_after_total = 0
+
+    def _pace(self, chat_id):
+        pace = self.chats.peek(chat_id)
+        if pace is None: self.chats.put(chat_id, pace := ChatPace(asyncio.Lock(), deque(maxlen=SEND_GROUP_PER_MINUTE), [0.0]))
+        return pace
+
+    def _delay(self, chat_id, pace):
+        now = time.monotonic()
+        delay = pace.until[0] - now
+        if pace.sent: delay = max(delay, pace.sent[-1] + SEND_CHAT_INTERVAL - now)
+        if chat_id < 0 and len(pace.sent) == SEND_GROUP_PER_MINUTE: delay = max(delay, pace.sent[0] + 60 - now)
+        return delay
+
+    async def _global_turn(self):
+        now = time.monotonic()
+        at = max(now, self.global_next)
+        self.global_next = at + 1 / SEND_GLOBAL_RATE
+        if at > now: await asyncio.sleep(at - now)
+
+    # retry=False — для проміжних правок: після retry_after чат стає на паузу, а помилка йде далі
+    async def send(self, chat_id, call, retry=True):
+        pace = self._pace(chat_id)
+        self.pending += 1
+        start = time.perf_counter()
+        try:
+            async with pace.lock:
+                for attempt in range(SEND_RETRY_ATTEMPTS + 1):
+                    if (delay := self._delay(chat_id, pace)) > 0: await asyncio.sleep(delay)
+                    await self._global_turn()
+                    metrics.observe("bot_send_wait_seconds", time.perf_counter() - start)
+                    try:
+                        result = await call()
+                        pace.sent.append(time.monotonic())
+                        self.sent_total += 1
+                        return result
+                    except TelegramRetryAfter as e:
+                        self.retry_after_total += 1
+                        metrics.inc("bot_send_retry_after_total")
+                        pace.until[0] = time.monotonic() + e.retry_after
+                        logging.warning(f"Telegram retry_after {e.retry_after}с у чаті {chat_id}")
+                        if not retry or attempt == SEND_RETRY_ATTEMPTS: raise
+        finally: self.pending -= 1
+
+    def stats(self):
+        return f"в черзі {self.pending}, надіслано {self.sent_total}, retry_after {self.retry_after_total}"
+
+send_queue = SendQueue()
+metrics.gauge("bot_send_pending", lambda: send_queue.pending)
+
 async def send_chunked_response(message_obj, text):
-    async def send_safe(chunk):
-        try: 
-            sent_msg = await message_obj.answer(chunk, parse_mode=ParseMode.MARKDOWN)
-            await save_to_db(sent_msg) 
-            return sent_msg
-        except: 
-            try: 
-                sent_msg = await message_obj.answer(chunk, parse_mode=None)
-                await save_to_db(sent_msg)
-                return sent_msg
-            except: return None
-
-    if len(text) <= 4000: 
-        await send_safe(text)
-    else:
-        for chunk in [text[i:i+4000] for i in range(0, len(text), 4000)]: 
-            await send_safe(chunk)
+    for piece in split_markdown(text):
+        plain, entities = render_markdown(piece)
+        try: sent_msg = await send_queue.send(message_obj.chat.id, lambda: message_obj.answer(plain, entities=entities, parse_mode=None))
+        except TelegramBadRequest as e:
+            # Напр. посилання, яке Telegram не прийняв — шлемо як є
+            logging.warning(f"Send entities rejected: {e}")
+            try: sent_msg = await send_queue.send(message_obj.chat.id, lambda: message_obj.answer(piece, parse_mode=None))
+            except TelegramBadRequest: continue
+        await save_to_db(sent_msg)
+
+# --- КОНТЕКСТ ДЛЯ GPT ---
+# Бюджет вхідних токенів на запит для кожної моделі з AVAILABLE_MODELS
+MODEL_INPUT_BUDGET = {
+    "gpt-5-mini": 24000,
+    "gpt-5.2-chat-latest": 24000,
+    "gpt-5-pro": 48000,
+}
+DEFAULT_INPUT_BUDGET = 24000
+TURN_OVERHEAD_TOKENS = 4
+CONTEXT_KEEP_RECENT = 2  # найновіші репліки йдуть повністю за будь-якого бюджету
+CONTEXT_MIN_TRUNCATED = 50  # коротший за це обрізаний текст уже не має сенсу
+
+# turns — [(role, text, photo)] від старих до нових. Старші репліки спершу втрачають фото,
+# потім обрізаються, потім відкидаються. Повертає (репліки, скільки токенів обрізано).
+def build_context(model, sys_prompt, turns):
+    budget = MODEL_INPUT_BUDGET.get(model, DEFAULT_INPUT_BUDGET)
+    img_tokens = image_tokens(model)
+    if sys_prompt: budget -= estimate_tokens(sys_prompt) + TURN_OVERHEAD_TOKENS
+    kept, trimmed = [], 0
+    for i, (role, text, photo) in enumerate(reversed(turns)):
+        text_cost, img_cost = estimate_tokens(text), img_tokens if photo else 0
+        need = text_cost + img_cost + TURN_OVERHEAD_TOKENS
+        if i < CONTEXT_KEEP_RECENT or need <= budget:
+            kept.append((role, text, photo)); budget -= need; continue
+        if photo:
+            photo, need, trimmed = None, need - img_cost, trimmed + img_cost
+            if text and need <= budget:
+                kept.append((role, text, None)); budget -= need; continue
+        room = budget - TURN_OVERHEAD_TOKENS
+        # Репліка лише з фото, що не влізло: старші короткі репліки ще можуть поміститися
+        if not text and room >= CONTEXT_MIN_TRUNCATED: continue
+        if text and room >= CONTEXT_MIN_TRUNCATED:
+            short = text[:room * 3 - 3] + "…"
+            kept.append((role, short, None)); trimmed += text_cost - estimate_tokens(short)
+        else: trimmed += text_cost
+        # Далі бюджету немає: решту старших реплік відкидаємо
+        trimmed += sum(estimate_tokens(t) + (img_tokens if f else 0) for _, t, f in turns[:len(turns) - i - 1])
+        break
+    kept.reverse()
+    return kept, trimmed
+
+# --- СТРІМІНГ ВІДПОВІДЕЙ ---
+# Відповідь з'являється одразу в повідомленні-заглушці й дописується правками не частіше
+# ніж раз на STREAM_EDIT_INTERVAL с (у групах Telegram дає ~20 повідомлень/правок на хвилину).
+GPT_STREAM = os.getenv("GPT_STREAM", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "3"))
+STREAM_CURSOR = " ▌"
+
+# Фінальна правка з розміткою (або без, якщо Telegram її не прийняв); в базу йде лише вона
+async def finish_streamed(sent, text):
+    plain, entities = render_markdown(text)
+    try: final = await send_queue.send(sent.chat.id, lambda: sent.edit_text(plain, entities=entities, parse_mode=None))
+    except TelegramBadRequest:
+        try: final = await send_queue.send(sent.chat.id, lambda: sent.edit_text(text, parse_mode=None))
+        except TelegramBadRequest: return
+    await save_to_db(final)
+
+async def stream_gpt_response(message_obj, stream, model):
+    chat_id = message_obj.chat.id
+    sent = await send_queue.send(chat_id, lambda: message_obj.answer("⏳"))
+    buf, next_edit = "", 0.0
+    async for chunk in stream:
+        if chunk.usage: record_usage(model, chunk.usage)
+        delta = chunk.choices[0].delta.content if chunk.choices else None
+        if not delta: continue
+        buf += delta
+        # Переповнене повідомлення закриваємо по межі абзацу чи блоку коду і продовжуємо в новому
+        # Хвіст лишається сирим: пробіли й переноси на межі потрібні наступній дельті
+        if utf16_len(buf) > MESSAGE_LIMIT and len(pieces := split_markdown(buf, strip=False)) > 1 \
+                and (done := [p.strip() for p in pieces[:-1] if p.strip()]):
+            buf = pieces[-1]
+            await finish_streamed(sent, done[0])
+            if done[1:]: await send_chunked_response(message_obj, "\n\n".join(done[1:]))
+            sent = await send_queue.send(chat_id, lambda: message_obj.answer(buf + STREAM_CURSOR))
+            next_edit = time.monotonic() + STREAM_EDIT_INTERVAL
+        if buf.strip() and time.monotonic() >= next_edit:
+            try: await send_queue.send(chat_id, lambda: sent.edit_text(buf + STREAM_CURSOR, parse_mode=None), retry=False)
+            except TelegramRetryAfter as e: next_edit = time.monotonic() + e.retry_after; continue
+            except TelegramBadRequest: pass
+            next_edit = time.monotonic() + STREAM_EDIT_INTERVAL
+    if buf.strip(): await finish_streamed(sent, buf)
+    else: await sent.delete()
 
 def get_cutoff_date(p):
     n = datetime.utcnow()
     return n-timedelta(days=1) if p=='1d' else n-timedelta(days=7) if p=='7d' else n-timedelta(days=30) if p=='30d' else None
 
+# Активність за період: ролап по повних днях + сирий msg_meta лише за перший, неповний день.
+# Вартість залежить від кількості днів і юзерів, а не повідомлень. p — номер параметра з датою.
+def activity_sql(cut, p):
+    if not cut: return "SELECT chat_id, user_id, msg_type, cnt FROM msg_daily_stats"
+    return (f"SELECT chat_id, user_id, msg_type, cnt FROM msg_daily_stats WHERE day > ${p}::timestamp::date"
+            f" UNION ALL SELECT chat_id, user_id, msg_type, 1 FROM msg_meta WHERE date_msg >= ${p} AND date_msg < ${p}::timestamp::date + 1")
+
 def get_period_name(p): return "24 години" if p=='1d' else "7 днів" if p=='7d' else "30 днів" if p=='30d' else "Весь час"
 
 # --- 🔥 ГЛОБАЛЬНЕ БЛОКУВАННЯ ШИЗОЇДА ---
@@ -202,17 +1556,17 @@ async def global_shizoid_block(message: types.Message):
 # --- НАЛАШТУВАННЯ ---
 @dp.message(F.text.startswith('!system'))
 async def cmd_set_system(m: types.Message):
-    await save_to_db(m); t = m.text[8:].strip()
+    await save_to_db(m, flush=True); t = m.text[8:].strip()
     if not t:
-        async with db_pool.acquire() as con: cur = await con.fetchval("SELECT system_prompt FROM chats WHERE chat_id=$1", m.chat.id)
+        cur = (await get_chat_settings(m.chat.id)).system_prompt
         await m.answer(f"🧠 <b>Установка:</b>\n<code>{cur if cur else '(Пусто)'}</code>", parse_mode=ParseMode.HTML); return
-    async with db_pool.acquire() as con: await con.execute("UPDATE chats SET system_prompt=$1 WHERE chat_id=$2", t, m.chat.id)
+    await update_chat_settings(m.chat.id, system_prompt=t)
     await m.answer(f"✅ <b>Нова особистість:</b> {t}", parse_mode=ParseMode.HTML)
 
 @dp.message(F.text.lower().startswith('!clearsystem'))
 async def cmd_clear_system(m: types.Message):
-    await save_to_db(m)
-    async with db_pool.acquire() as con: await con.execute("UPDATE chats SET system_prompt=NULL WHERE chat_id=$1", m.chat.id)
+    await save_to_db(m, flush=True)
+    await update_chat_settings(m.chat.id, system_prompt=None)
     await m.answer("🔄 <b>Скинуто.</b>", parse_mode=ParseMode.HTML)
 
 @dp.message(F.text.lower().startswith('!forget'))
@@ -220,22 +1574,21 @@ async def cmd_forget(m: types.Message): await save_to_db(m); await m.answer("
 
 @dp.message(F.text.lower().startswith('!temp'))
 async def cmd_set_temp(m: types.Message):
-    await save_to_db(m); args = m.text.split()
+    await save_to_db(m, flush=True); args = m.text.split()
     if len(args)<2:
-        async with db_pool.acquire() as con: cur = await con.fetchval("SELECT temperature FROM chats WHERE chat_id=$1", m.chat.id)
+        cur = (await get_chat_settings(m.chat.id)).temperature
         await m.answer(f"🌡 <b>Температура:</b> {cur if cur is not None else DEFAULT_TEMPERATURE}", parse_mode=ParseMode.HTML); return
     try:
         val = float(args[1])
         if not (0<=val<=2): await m.answer("❌ 0.0 - 2.0"); return
-        async with db_pool.acquire() as con: await con.execute("UPDATE chats SET temperature=$1 WHERE chat_id=$2", val, m.chat.id)
+        await update_chat_settings(m.chat.id, temperature=val)
         await m.answer(f"🌡 <b>Встановлено:</b> {val}", parse_mode=ParseMode.HTML)
     except: await m.answer("❌ Число треба.")
 
 @dp.message(F.text.lower().startswith('!models') | F.text.lower().startswith('!model'))
 async def cmd_models_menu(m: types.Message):
     await save_to_db(m)
-    async with db_pool.acquire() as con: cur = await con.fetchval("SELECT model_name FROM chats WHERE chat_id=$1", m.chat.id)
-    cur = cur if cur else DEFAULT_MODEL
+    cur = (await get_chat_settings(m.chat.id)).model_name or DEFAULT_MODEL
     b = InlineKeyboardBuilder()
     for mod in AVAILABLE_MODELS: b.button(text=f"✅ {mod}" if mod==cur else mod, callback_data=f"set_mdl_{mod}")
     b.adjust(1)
@@ -245,15 +1598,70 @@ async def cmd_models_menu(m: types.Message):
 async def cb_set_model(c: CallbackQuery):
     mod = c.data.replace("set_mdl_", "")
     if mod not in AVAILABLE_MODELS: await c.answer("❌ Нема такої.", show_alert=True); return
-    async with db_pool.acquire() as con: await con.execute("UPDATE chats SET model_name=$1 WHERE chat_id=$2", mod, c.message.chat.id)
+    await update_chat_settings(c.message.chat.id, model_name=mod)
     await c.message.edit_text(f"💾 <b>Встановлено:</b> <code>{mod}</code>", parse_mode=ParseMode.HTML)
 
+# --- ANALYZE: MAP-REDUCE ---
+# Великі вибірки ріжуться на шматки за оцінкою токенів; шматки аналізуються паралельно,
+# нотатки зводяться одним запитом. Нотатки кешуються за (чат, юзер, модель, перший msg_id)
+# разом з останнім msg_id шматка, тож повторний аналіз рахує лише нові повідомлення.
+ANALYZE_SYSTEM_PROMPT = "Психоаналітик."
+ANALYZE_CHUNK_TOKENS = int(os.getenv("ANALYZE_CHUNK_TOKENS", "6000"))
+ANALYZE_CONCURRENCY = int(os.getenv("ANALYZE_CONCURRENCY", "4"))
+analyze_cache = LRUCache(int(os.getenv("ANALYZE_CACHE_SIZE", "2000")))
+metrics.cache("analyze", analyze_cache)
+
+# rows — [(msg_id, текст)] від старих до нових; повертає [(шматок, закешовані нотатки або None)]
+def plan_analyze_chunks(key, rows):
+    pos = {msg_id: i for i, (msg_id, _) in enumerate(rows)}
+    plan, i = [], 0
+    while i < len(rows):
+        hit = analyze_cache.get((*key, rows[i][0]))
+        if hit and pos.get(hit[0], -1) >= i:
+            j = pos[hit[0]] + 1
+            plan.append((rows[i:j], hit[1]))
+            i = j
+            continue
+        # Новий шматок — до ліміту токенів або до початку вже закешованого
+        j, size = i, 0
+        while j < len(rows):
+            t = estimate_tokens(rows[j][1])
+            if j > i and (size + t > ANALYZE_CHUNK_TOKENS or (*key, rows[j][0]) in analyze_cache): break
+            size += t
+            j += 1
+        plan.append((rows[i:j], None))
+        i = j
+    return plan
+
+async def analyze_messages(chat_id, uid, uname, model, rows):
+    async def ask(prompt, limit=False):
+        async with gpt_scheduler.slot(chat_id, model, limit=limit):
+            resp = await gpt_scheduler.call(model, lambda: gpt_client.chat.completions.create(model=model, messages=[{"role": "system", "content": ANALYZE_SYSTEM_PROMPT}, {"role": "user", "content": prompt}]))
+        return resp.choices[0].message.content
+
+    key = (chat_id, uid, model)
+    plan = plan_analyze_chunks(key, rows)
+    if len(plan) == 1 and plan[0][1] is None:
+        return await ask(f"Проаналізуй {uname}:\n" + "\n".join(t for _, t in rows), limit=True)
+
+    sem = asyncio.Semaphore(ANALYZE_CONCURRENCY)
+    async def summarize(chunk, cached):
+        if cached is not None: return cached
+        async with sem:
+            notes = await ask(f"Фрагмент повідомлень {uname}. Коротко випиши риси характеру, теми, настрої й патерни для подальшого аналізу:\n" + "\n".join(t for _, t in chunk))
+        analyze_cache.put((*key, chunk[0][0]), (chunk[-1][0], notes))
+        return notes
+
+    parts = await asyncio.gather(*(summarize(chunk, cached) for chunk, cached in plan))
+    logging.info(f"Analyze {chat_id}/{uid}: шматків {len(plan)}, з кешу {sum(cached is not None for _, cached in plan)}")
+    return await ask(f"Нотатки про {uname} по фрагментах листування, від старих до нових:\n\n" + "\n\n".join(f"[{i + 1}] {p}" for i, p in enumerate(parts)) + f"\n\nПроаналізуй {uname} цілісно на основі цих нотаток.")
+
 # --- ANALYZE ---
 @dp.message(F.text.lower().startswith('!analyze'))
 async def cmd_analyze_menu(m: types.Message):
     await save_to_db(m)
-    sql="SELECT u.user_id, u.first_name, COUNT(m.msg_id) as cnt FROM msg_meta m JOIN users u ON m.user_id=u.user_id JOIN msg_txt t ON m.chat_id=t.chat_id AND m.msg_id=t.msg_id WHERE m.chat_id=$1 GROUP BY u.user_id, u.first_name ORDER BY cnt DESC LIMIT 20"
-    async with db_pool.acquire() as con: rows = await con.fetch(sql, m.chat.id)
+    sql="SELECT u.user_id, u.first_name, COUNT(m.msg_id) as cnt FROM msg_meta m JOIN users u ON m.user_id=u.user_id JOIN msg_txt t ON "+txt_join("m", "t")+" WHERE m.chat_id=$1 GROUP BY u.user_id, u.first_name ORDER BY cnt DESC LIMIT 20"
+    async with db_conn("analyze_menu") as con: rows = await con.fetch(sql, m.chat.id)
     if not rows: await m.answer("Пусто."); return
     b = InlineKeyboardBuilder()
     for r in rows: b.button(text=r['first_name'], callback_data=f"anlz_sel_{r['user_id']}")
@@ -273,25 +1681,70 @@ async def cb_sel(c: CallbackQuery):
 async def cb_run(c: CallbackQuery):
     _, _, uid, lim = c.data.split("_"); uid, lim = int(uid), int(lim)
     if lim==1000 and c.from_user.id!=ADMIN_ID:
-        async with db_pool.acquire() as con:
+        async with db_conn() as con:
             lr = await con.fetchval("SELECT last_1000_analyze FROM users WHERE user_id=$1", c.from_user.id)
             if lr and datetime.utcnow() < (nxt:=lr+timedelta(hours=24)):
                 d=nxt-datetime.utcnow(); await c.answer(f"⛔ Чекай {d.seconds//3600}год", show_alert=True); return
             await con.execute("UPDATE users SET last_1000_analyze=$1 WHERE user_id=$2", datetime.utcnow(), c.from_user.id)
     await c.message.edit_text("⏳ <b>Думаю...</b>", parse_mode=ParseMode.HTML)
-    sql="SELECT t.msg_txt FROM msg_meta m JOIN msg_txt t ON m.chat_id=t.chat_id AND m.msg_id=t.msg_id WHERE m.chat_id=$1 AND m.user_id=$2 AND t.msg_txt!='' ORDER BY m.date_msg DESC LIMIT $3"
-    async with db_pool.acquire() as con:
+    sql="SELECT m.msg_id, t.msg_txt FROM msg_meta m JOIN msg_txt t ON "+txt_join("m", "t")+" WHERE m.chat_id=$1 AND m.user_id=$2 AND t.msg_txt!='' ORDER BY m.date_msg DESC LIMIT $3"
+    async with db_conn("analyze_select") as con:
         rows = await con.fetch(sql, c.message.chat.id, uid, lim)
         uname = await con.fetchval("SELECT first_name FROM users WHERE user_id=$1", uid)
-        mod = await con.fetchval("SELECT model_name FROM chats WHERE chat_id=$1", c.message.chat.id)
-    txts = [r['msg_txt'] for r in rows if r['msg_txt'].strip()]
+    mod = (await get_chat_settings(c.message.chat.id)).model_name
+    txts = [(r['msg_id'], r['msg_txt']) for r in reversed(rows) if r['msg_txt'].strip()]
     if not txts: await c.message.edit_text("❌ Пусто."); return
     try:
-        resp = await gpt_client.chat.completions.create(model=mod or DEFAULT_MODEL, messages=[{"role":"system","content":"Психоаналітик."},{"role":"user","content":f"Проаналізуй {uname}:\n"+"\n".join(txts)}])
+        report = await analyze_messages(c.message.chat.id, uid, uname, mod or DEFAULT_MODEL, txts)
         await c.message.delete()
-        await send_chunked_response(c.message, f"🧠 <b>Аналіз {uname}:</b>\n\n{resp.choices[0].message.content}")
+        await send_chunked_response(c.message, f"🧠 **Аналіз {uname}:**\n\n{report}")
+    except GptQueueFull: await c.message.edit_text("🚦 <b>Черга переповнена, спробуй пізніше.</b>", parse_mode=ParseMode.HTML)
     except Exception as e: await c.message.answer(f"Error: {e}")
 
+# --- SEARCH ---
+def message_link(chat_id, msg_id):
+    # Посилання на повідомлення є лише в супергрупах (-100…)
+    return f"https://t.me/c/{str(chat_id)[4:]}/{msg_id}" if str(chat_id).startswith("-100") else None
+
+async def render_search(chat_id, query, page):
+    rows = await search_messages(chat_id, SEARCH_TSQUERY, query, SEARCH_PAGE_SIZE + 1, page * SEARCH_PAGE_SIZE)
+    if not rows: return ("🔎 Нічого не знайдено." if page == 0 else "🔎 Більше нічого."), None
+    lines = []
+    for r in rows[:SEARCH_PAGE_SIZE]:
+        date, link = f"{r['date_msg']:%d.%m.%Y}", message_link(chat_id, r['msg_id'])
+        txt = r['msg_txt'] if len(r['msg_txt']) <= SEARCH_SNIPPET else r['msg_txt'][:SEARCH_SNIPPET] + "…"
+        if link: date = f'<a href="{link}">{date}</a>'
+        lines.append(f"{date} <b>{html.escape(r['first_name'] or '?')}</b>: {html.escape(txt)}")
+    b = InlineKeyboardBuilder()
+    if page > 0: b.button(text="⬅️", callback_data=f"srch_{page - 1}")
+    if len(rows) > SEARCH_PAGE_SIZE: b.button(text="➡️", callback_data=f"srch_{page + 1}")
+    return f"🔎 <b>{html.escape(query)}</b> (стор. {page + 1})\n\n" + "\n\n".join(lines), b.as_markup()
+
+# Відповідь прив'язана реплаєм до команди: запит для гортання береться звідти, а не з callback_data (≤64 байти)
+@dp.message(F.text.lower().startswith('!search'))
+async def cmd_search(m: types.Message):
+    await save_to_db(m, flush=True)
+    query = m.text[8:].strip()
+    if not query: await m.answer("🔎 <b>!search</b> слова, \"фраза\", -виключити", parse_mode=ParseMode.HTML); return
+    txt, kb = await render_search(m.chat.id, query, 0)
+    await m.reply(txt, parse_mode=ParseMode.HTML, reply_markup=kb, disable_web_page_preview=True)
+
+@dp.callback_query(F.data.startswith("srch_"))
+async def cb_search(c: CallbackQuery):
+    src = c.message.reply_to_message
+    if not src or not src.text: await c.answer("❌ Запит видалено.", show_alert=True); return
+    txt, kb = await render_search(c.message.chat.id, src.text[8:].strip(), int(c.data.split("_")[1]))
+    await c.message.edit_text(txt, parse_mode=ParseMode.HTML, reply_markup=kb, disable_web_page_preview=True)
+
+@dp.message(F.text.lower().startswith('!memory'))
+async def cmd_memory(m: types.Message):
+    await save_to_db(m, flush=True); args = m.text.split()
+    if len(args) < 2 or args[1].lower() not in ("on", "off"):
+        cur = (await get_chat_settings(m.chat.id)).memory
+        await m.answer(f"🧠 <b>Пам'ять GPT:</b> {'увімкнена' if (MEMORY_DEFAULT if cur is None else cur) else 'вимкнена'} (!memory on/off)", parse_mode=ParseMode.HTML); return
+    await update_chat_settings(m.chat.id, memory=args[1].lower() == "on")
+    await m.answer(f"🧠 <b>Встановлено:</b> {args[1].lower()}", parse_mode=ParseMode.HTML)
+
 # --- STATS, IGNORE, ETC ---
 @dp.message(F.text.lower().startswith('!stats'))
 async def cmd_st(m: types.Message):
@@ -310,9 +1763,10 @@ async def cb_per(c: CallbackQuery):
 @dp.callback_query(F.data.startswith("res_grp_"))
 async def cb_res_g(c: CallbackQuery):
     per = c.data.split("_")[2]; cut = get_cutoff_date(per)
-    sql_c = "SELECT COUNT(*) FROM msg_meta WHERE chat_id=$1" + (" AND date_msg>=$2" if cut else "")
-    sql_t = "SELECT u.first_name, COUNT(m.msg_id) as cnt FROM msg_meta m JOIN users u ON m.user_id=u.user_id WHERE m.chat_id=$1" + (" AND m.date_msg>=$2" if cut else "") + " GROUP BY u.first_name ORDER BY cnt DESC LIMIT 5"
-    async with db_pool.acquire() as con:
+    src = activity_sql(cut, 2)
+    sql_c = f"SELECT COALESCE(SUM(s.cnt), 0) FROM ({src}) s WHERE s.chat_id=$1"
+    sql_t = f"SELECT u.first_name, SUM(s.cnt) as cnt FROM ({src}) s JOIN users u ON s.user_id=u.user_id WHERE s.chat_id=$1 GROUP BY u.first_name ORDER BY cnt DESC LIMIT 5"
+    async with db_conn("stats_group") as con:
         tot = await con.fetchval(sql_c, c.message.chat.id, *([cut] if cut else []))
         top = await con.fetch(sql_t, c.message.chat.id, *([cut] if cut else []))
     txt = f"📊 <b>Стат ({get_period_name(per)})</b>: {tot}\n" + "\n".join([f"{i+1}. {r['first_name']} - {r['cnt']}" for i,r in enumerate(top)])
@@ -321,55 +1775,95 @@ async def cb_res_g(c: CallbackQuery):
 @dp.callback_query(F.data.startswith("list_usr_"))
 async def cb_lst(c: CallbackQuery):
     per=c.data.split("_")[2]; cut=get_cutoff_date(per)
-    sql="SELECT u.user_id, u.first_name, COUNT(m.msg_id) as cnt FROM msg_meta m JOIN users u ON m.user_id=u.user_id WHERE m.chat_id=$1" + (" AND m.date_msg>=$2" if cut else "") + " GROUP BY u.user_id, u.first_name ORDER BY cnt DESC LIMIT 20"
-    async with db_pool.acquire() as con: rows=await con.fetch(sql, c.message.chat.id, *([cut] if cut else []))
+    sql=f"SELECT u.user_id, u.first_name, SUM(s.cnt) as cnt FROM ({activity_sql(cut, 2)}) s JOIN users u ON s.user_id=u.user_id WHERE s.chat_id=$1 GROUP BY u.user_id, u.first_name ORDER BY cnt DESC LIMIT 20"
+    async with db_conn("stats_users") as con: rows=await con.fetch(sql, c.message.chat.id, *([cut] if cut else []))
     b=InlineKeyboardBuilder()
     for r in rows: b.button(text=r['first_name'], callback_data=f"stat_u_{r['user_id']}_{per}")
     b.button(text="🔙",callback_data="ask_period_user"); await c.message.edit_text("Топ:", reply_markup=b.as_markup())
 
 @dp.callback_query(F.data.startswith("stat_u_"))
 async def cb_u_det(c: CallbackQuery):
-    _, _, uid, per = c.data.split("_"); uid=int(uid); cut=get_cutoff_date(per)
-    async with db_pool.acquire() as con:
+    _, _, uid, per = c.data.split("_"); uid=int(uid); cut=get_cutoff_date(per); src=activity_sql(cut, 3)
+    async with db_conn("stats_user") as con:
         n = await con.fetchval("SELECT first_name FROM users WHERE user_id=$1", uid)
-        tot = await con.fetchval("SELECT COUNT(*) FROM msg_meta WHERE chat_id=$1 AND user_id=$2" + (" AND date_msg>=$3" if cut else ""), c.message.chat.id, uid, *([cut] if cut else []))
-        sts = await con.fetch("SELECT msg_type, COUNT(*) as cnt FROM msg_meta WHERE chat_id=$1 AND user_id=$2" + (" AND date_msg>=$3" if cut else "") + " GROUP BY msg_type ORDER BY cnt DESC", c.message.chat.id, uid, *([cut] if cut else []))
+        sts = await con.fetch(f"SELECT s.msg_type, SUM(s.cnt) as cnt FROM ({src}) s WHERE s.chat_id=$1 AND s.user_id=$2 GROUP BY s.msg_type ORDER BY cnt DESC", c.message.chat.id, uid, *([cut] if cut else []))
+    tot = sum(r['cnt'] for r in sts)
     txt = f"👤 <b>{n}</b> ({get_period_name(per)})\n📨 {tot}\n" + "\n".join([f"🔹 {r['msg_type']}: {r['cnt']}" for r in sts])
     b=InlineKeyboardBuilder(); b.button(text="🔙",callback_data=f"list_usr_{per}"); await c.message.edit_text(txt, parse_mode=ParseMode.HTML, reply_markup=b.as_markup())
 
+# Разовий перерахунок ролапу з усієї історії msg_meta
+@dp.message(F.text.lower().startswith('!backfillstats'))
+async def cmd_backfill_stats(m: types.Message):
+    if m.from_user.id!=ADMIN_ID: return
+    await save_to_db(m, flush=True)
+    async with db_conn() as con:
+        async with con.transaction():
+            # Паралельні записи чекають на лок і додадуть свої лічильники вже поверх перерахунку
+            await con.execute("LOCK TABLE msg_daily_stats IN EXCLUSIVE MODE")
+            await con.execute("DELETE FROM msg_daily_stats")
+            res = await con.execute("INSERT INTO msg_daily_stats (chat_id, user_id, day, msg_type, cnt) SELECT chat_id, user_id, date_msg::date, msg_type, COUNT(*) FROM msg_meta GROUP BY 1, 2, 3, 4")
+    await m.answer(f"✅ <b>Ролап перераховано:</b> {res.split()[-1]} рядків", parse_mode=ParseMode.HTML)
+
 @dp.message(F.text.lower().startswith('!ignorehere'))
 async def cmd_ign(m: types.Message):
-    await save_to_db(m)
-    async with db_pool.acquire() as con:
+    await save_to_db(m, flush=True)
+    roster = await load_roster(m.chat.id)
+    async with db_conn() as con:
         if await con.execute("DELETE FROM here_ignore WHERE chat_id=$1 AND user_id=$2", m.chat.id, m.from_user.id) == "DELETE 1":
+            roster.set_ignored(m.from_user.id, False)
             await m.answer("👻 <b>Ти в грі.</b>", parse_mode=ParseMode.HTML)
         else:
             await con.execute("INSERT INTO here_ignore (chat_id, user_id) VALUES ($1, $2)", m.chat.id, m.from_user.id)
+            roster.set_ignored(m.from_user.id, True)
             await m.answer("🔕 <b>Ігнор увімкнено.</b>", parse_mode=ParseMode.HTML)
 
 @dp.message(F.text.lower().startswith('!roulette'))
 async def cmd_rl(m: types.Message):
     if m.chat.type=='private': return
     await save_to_db(m)
-    sql="SELECT * FROM (SELECT DISTINCT u.user_id, u.username, u.first_name FROM users u JOIN msg_meta m ON u.user_id=m.user_id LEFT JOIN here_ignore hi ON u.user_id=hi.user_id AND m.chat_id=hi.chat_id WHERE m.chat_id=$1 AND hi.user_id IS NULL) t ORDER BY RANDOM() LIMIT 1"
-    async with db_pool.acquire() as con: r=await con.fetchrow(sql, m.chat.id)
-    if r: await m.answer(f"{'@'+r['username'] if r['username'] else r['first_name']} - НУ ТИ І ПІДАРАС", parse_mode=ParseMode.HTML)
+    r=(await load_roster(m.chat.id)).pick()
+    if r: _, username, first_name = r; await m.answer(f"{'@'+username if username else first_name} - НУ ТИ І ПІДАРАС", parse_mode=ParseMode.HTML)
 
 @dp.message(F.text.lower().startswith('!here'))
 async def cmd_hr(m: types.Message):
     await save_to_db(m)
-    sql="SELECT DISTINCT u.user_id, u.username, u.first_name FROM users u JOIN msg_meta m ON u.user_id=m.user_id LEFT JOIN here_ignore hi ON u.user_id=hi.user_id AND m.chat_id=hi.chat_id WHERE m.chat_id=$1 AND hi.user_id IS NULL"
-    async with db_pool.acquire() as con: rows=await con.fetch(sql, m.chat.id)
-    lst=[f"@{r['username']}" if r['username'] else f"<a href='tg://user?id={r['user_id']}'>{r['first_name']}</a>" for r in rows]
+    rows=(await load_roster(m.chat.id)).listed()
+    lst=[f"@{username}" if username else f"<a href='tg://user?id={uid}'>{first_name}</a>" for uid, username, first_name in rows]
     await m.answer("📢 <b>ЗБІР</b>\n"+(" ".join(lst) if lst else "Всі в ігнорі"), parse_mode=ParseMode.HTML)
 
 @dp.message(F.text.lower().startswith('!help'))
-async def cmd_h(m: types.Message): await save_to_db(m); await m.answer("Команди: !текст, !models, !analyze, !system, !forget, !temp, !stats, !here, !ignorehere, !roulette", parse_mode=ParseMode.HTML)
+async def cmd_h(m: types.Message): await save_to_db(m); await m.answer("Команди: !текст, !models, !analyze, !search, !memory, !system, !forget, !temp, !stats, !here, !ignorehere, !roulette", parse_mode=ParseMode.HTML)
 
 @dp.message(F.text.startswith('!say') & (F.chat.type=='private'))
 async def cmd_say(m: types.Message): 
     if m.from_user.id==ADMIN_ID: await bot.send_message(TARGET_CHAT_ID, m.text[5:].strip())
 
+@dp.message(F.text.lower().startswith('!cache'))
+async def cmd_cache(m: types.Message):
+    if m.from_user.id!=ADMIN_ID: return
+    await m.answer(f"🗄 <b>Налаштування:</b> {settings_cache.stats()}\n"
+                   f"👤 <b>Users upsert:</b> {written_users.stats()}\n"
+                   f"💬 <b>Chats upsert:</b> {written_chats.stats()}\n"
+                   f"🖼 <b>Шляхи файлів:</b> {file_path_cache.stats()}\n"
+                   f"🗜 <b>Зображення:</b> {image_cache.stats()}\n"
+                   f"🕵️ <b>Нотатки аналізу:</b> {analyze_cache.stats()}", parse_mode=ParseMode.HTML)
+
+@dp.message(F.text.lower().startswith('!queue'))
+async def cmd_queue(m: types.Message):
+    if m.from_user.id!=ADMIN_ID: return
+    await m.answer(f"🚦 <b>GPT:</b> {gpt_scheduler.stats()}\n📤 <b>Доставка:</b> {send_queue.stats()}", parse_mode=ParseMode.HTML)
+
+@dp.message(F.text.lower().startswith('!metrics'))
+async def cmd_metrics(m: types.Message):
+    if m.from_user.id!=ADMIN_ID: return
+    txt = (f"📈 <b>Метрики</b>\n<pre>{html.escape(metrics.summary()) or '—'}</pre>\n"
+           f"🚦 <b>GPT:</b> {gpt_scheduler.stats()}\n"
+           f"📥 <b>Черга запису:</b> {ingest.pending()}\n"
+           f"🗄 <b>Налаштування:</b> {settings_cache.stats()}\n"
+           f"🧵 <b>Реплаї з пам'яті:</b> {metrics.counters.get(('bot_thread_context_total', (('source', 'memory'),)), 0)}, "
+           f"з бази: {metrics.counters.get(('bot_thread_context_total', (('source', 'db'),)), 0)}")
+    await m.answer(txt, parse_mode=ParseMode.HTML)
+
 @dp.message(F.entities & ~F.text.startswith('!'))
 async def ment_h(m: types.Message): await save_to_db(m); await check_for_sleeping_uzbeks(m)
 
@@ -385,7 +1879,7 @@ async def cmd_gpt(message: types.Message):
     command_word = full_text.split()[0].lower()
     
     # Список команд, які не повинні йти в GPT
-    if command_word in ['!here', '!stats', '!roulette', '!system', '!clearsystem', '!temp', '!help', '!say', '!analyze', '!forget', '!models', '!model', '!ignorehere']:
+    if command_word in ['!here', '!stats', '!roulette', '!system', '!clearsystem', '!temp', '!help', '!say', '!analyze', '!forget', '!models', '!model', '!ignorehere', '!cache', '!backfillstats', '!queue', '!metrics', '!search', '!memory']:
         return
 
     # 🔥 ЧИСТИЙ ТЕКСТ ЗАПИТУ (тільки після '!')
@@ -399,14 +1893,14 @@ async def cmd_gpt(message: types.Message):
     sys_prompt = DEFAULT_SYSTEM_PROMPT
     temperature = DEFAULT_TEMPERATURE
     model_to_use = DEFAULT_MODEL
+    memory = MEMORY_DEFAULT
     
     try:
-        async with db_pool.acquire() as con:
-            row = await con.fetchrow("SELECT system_prompt, temperature, model_name FROM chats WHERE chat_id=$1", chat_id)
-            if row:
-                if row['system_prompt']: sys_prompt = row['system_prompt']
-                if row['temperature'] is not None: temperature = row['temperature']
-                if row['model_name']: model_to_use = row['model_name']
+        settings = await get_chat_settings(chat_id)
+        if settings.system_prompt: sys_prompt = settings.system_prompt
+        if settings.temperature is not None: temperature = settings.temperature
+        if settings.model_name: model_to_use = settings.model_name
+        if settings.memory is not None: memory = settings.memory
     except: pass
 
     messages_payload = []
@@ -414,32 +1908,63 @@ async def cmd_gpt(message: types.Message):
 
     try:
         history_rows = await get_thread_context(chat_id, message.message_id)
+        turns = []
         for row in history_rows:
-            uid, text_content, file_id, name = row['user_id'], row['msg_txt'], row['file_id'], row['first_name'] or "User"
+            uid, text_content = row['user_id'], row['msg_txt']
+            photo = (row['file_id'], row['file_unique_id']) if row['file_id'] else None
             
             # 🔥 ОЧИЩАЄМО ТЕКСТ ДЛЯ AI (БЕЗ '!' і БЕЗ ПРИСТАВКИ ІМЕНІ)
             if text_content and text_content.startswith('!'):
                 text_content = text_content[1:].strip()
 
+            # Роль (user/assistant) задаємо на рівні об'єкта, тому в тексті лише сам текст
+            if text_content or photo:
+                turns.append(("assistant" if uid == bot_id else "user", text_content, photo))
+
+        # Пам'ять: релевантні старі повідомлення поза ланцюжком реплаїв, окремим системним блоком
+        recalled = None
+        if memory and prompt:
+            try: recalled = await recall_messages(chat_id, prompt, [row['msg_id'] for row in history_rows])
+            except Exception as e: logging.error(f"Memory recall error: {e}")
+        if recalled: messages_payload.append({"role": "system", "content": recalled})
+
+        turns, trimmed = build_context(model_to_use, "\n".join(filter(None, [sys_prompt, recalled])), turns)
+        if trimmed: logging.info(f"Context {chat_id}: обрізано ~{trimmed} токенів ({model_to_use})")
+
+        img_urls = await get_image_urls((photo for _, _, photo in turns), model_to_use)
+        for role, text_content, photo in turns:
             content_block = []
             if text_content:
-                # Передаємо тільки текст, бо роль (user/assistant) вже вказана в ролі об'єкта
-                final_text = text_content 
-                content_block.append({"type": "text", "text": final_text})
+                content_block.append({"type": "text", "text": text_content})
             
-            if file_id:
-                img_url = await get_image_url(file_id)
+            if photo:
+                img_url = img_urls.get(photo)
                 if img_url: content_block.append({"type": "image_url", "image_url": {"url": img_url}})
             
             if content_block:
-                messages_payload.append({"role": "assistant" if uid == bot_id else "user", "content": content_block})
+                messages_payload.append({"role": role, "content": content_block})
                 
     except Exception as e:
         messages_payload.append({"role": "user", "content": prompt})
 
+    notice = None
+    async def on_queued(pos):
+        nonlocal notice
+        notice = await message.reply(f"⏳ <b>В черзі</b> (попереду запитів із цього чату: {pos - 1})", parse_mode=ParseMode.HTML)
+
     try:
-        response = await gpt_client.chat.completions.create(model=model_to_use, messages=messages_payload, temperature=temperature)
-        await send_chunked_response(message, response.choices[0].message.content)
+        async with gpt_scheduler.slot(chat_id, model_to_use, on_queued=on_queued):
+            if notice:
+                try: await notice.delete()
+                except TelegramBadRequest: pass
+            if GPT_STREAM:
+                stream = await gpt_scheduler.call(model_to_use, lambda: gpt_client.chat.completions.create(model=model_to_use, messages=messages_payload, temperature=temperature, stream=True, stream_options={"include_usage": True}))
+                with metrics.timer("bot_openai_stream_seconds", model=model_to_use): await stream_gpt_response(message, stream, model_to_use)
+            else:
+                response = await gpt_scheduler.call(model_to_use, lambda: gpt_client.chat.completions.create(model=model_to_use, messages=messages_payload, temperature=temperature))
+                await send_chunked_response(message, response.choices[0].message.content)
+    except GptQueueFull:
+        await message.reply("🚦 <b>Забагато запитів у цьому чаті, спробуй пізніше.</b>", parse_mode=ParseMode.HTML)
     except Exception as e:
         await message.reply(f"Помилка AI: {e}")
 
@@ -450,14 +1975,187 @@ async def logger_handler(message: types.Message):
     try: await save_to_db(message)
     except: pass
 
-async def main():
+# --- ЗАПУСК ---
+async def startup(metrics_port=METRICS_PORT):
+    global maintenance_task
     await create_pool()
+    await init_schema()
+    ingest.start()
+    maintenance_task = asyncio.create_task(schema_maintenance())
+    return await start_metrics_server(metrics_port) if metrics_port else None
+
+async def shutdown(metrics_runner):
+    if metrics_runner: await metrics_runner.cleanup()
+    if maintenance_task: maintenance_task.cancel()
+    if image_pool: image_pool.shutdown(cancel_futures=True)
+    await ingest.stop()
+    if db_pool: await db_pool.close(); print("✅ БД закрито.")
+
+async def main():
+    metrics_runner = await startup()
     print("🚀 Бот запущено!")
-    try: await dp.start_polling(bot)
+    try:
+        # getUpdates не працює, поки встановлено вебхук (після роботи в режимі webhook)
+        await bot.delete_webhook()
+        await dp.start_polling(bot)
+    finally: await shutdown(metrics_runner)
+
+# --- WEBHOOK: ФРОНТ + ВОРКЕРИ ПО ЧАТАХ ---
+# Фронт приймає апдейти по HTTP, відкидає повтори за update_id і віддає кожен апдейт воркеру
+# chat_id % WEBHOOK_WORKERS. Чат завжди потрапляє в той самий процес, тож порядок у межах чату
+# і кеші в пам'яті (налаштування, ростер, реплаї) лишаються узгодженими.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # публічна адреса без шляху, напр. https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_PORT = int(os.getenv("PORT", "8080"))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", str(os.cpu_count() or 1)))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "10000"))
+UPDATE_DEDUP_SIZE = 50000
+WORKER_CHECK_INTERVAL = 5
+# Більше перезапусків за вікно — фронт виходить з помилкою, і платформа перезапускає dyno цілком
+WORKER_MAX_RESTARTS = 5
+WORKER_RESTART_WINDOW = 300
+
+UPDATE_CHAT_KEYS = ("message", "edited_message", "channel_post", "edited_channel_post", "my_chat_member", "chat_member", "chat_join_request", "message_reaction")
+
+def update_chat_id(data):
+    for key in UPDATE_CHAT_KEYS:
+        if key in data: return data[key]["chat"]["id"]
+    if "callback_query" in data:
+        cq = data["callback_query"]
+        return (cq.get("message") or {}).get("chat", {}).get("id") or cq["from"]["id"]
+    # Інлайн-запити, опитування тощо — шардимо за користувачем
+    for value in data.values():
+        if isinstance(value, dict) and "from" in value: return value["from"]["id"]
+    return 0
+
+def run_worker(index, updates):
+    # Зупинку шле фронт через чергу, щоб воркер встиг дописати чергу запису
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(worker_main(index, updates))
+
+# Ліміти OpenAI і Telegram спільні на весь бот, тож кожен із n воркерів бере свою частку
+def share_limits(n):
+    global SEND_GLOBAL_RATE
+    caps = {"GPT_MAX_CONCURRENCY": GPT_MAX_CONCURRENCY, **{f"ліміт {m}": c for m, c in GPT_MODEL_CONCURRENCY.items()}}
+    for name, cap in caps.items():
+        if cap < n: logging.warning(f"⚠️ {name}={cap} менше за кількість воркерів ({n}): кожен отримає 1, разом до {n}")
+    gpt_scheduler.max_running = max(1, GPT_MAX_CONCURRENCY // n)
+    gpt_scheduler.model_limits = {m: max(1, c // n) for m, c in GPT_MODEL_CONCURRENCY.items()}
+    SEND_GLOBAL_RATE = SEND_GLOBAL_RATE / n
+
+async def worker_main(index, updates):
+    share_limits(WEBHOOK_WORKERS)
+    metrics_runner = await startup(METRICS_PORT + 1 + index if METRICS_PORT else 0)
+    loop = asyncio.get_running_loop()
+    tasks = set()
+    logging.info(f"👷 Воркер {index} запущено")
+    try:
+        while (data := await loop.run_in_executor(None, updates.get)) is not None:
+            # Задачі стартують у порядку надходження, як і в polling
+            update = types.Update.model_validate(data, context={"bot": bot})
+            task = asyncio.create_task(dp.feed_update(bot, update))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks: await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        await shutdown(metrics_runner)
+        await bot.session.close()
+
+async def webhook_front():
+    ctx = multiprocessing.get_context("spawn")
+    queues = [ctx.Queue(WEBHOOK_QUEUE_SIZE) for _ in range(WEBHOOK_WORKERS)]
+
+    def start_worker(i):
+        w = ctx.Process(target=run_worker, args=(i, queues[i]), name=f"bot-worker-{i}")
+        w.start()
+        return w
+
+    workers = [start_worker(i) for i in range(len(queues))]
+    seen = LRUCache(UPDATE_DEDUP_SIZE)
+    stop = asyncio.Event()
+    failed = False
+
+    # Мертвий воркер перезапускається на тій самій черзі, тож апдейти його чатів не губляться
+    async def supervise():
+        nonlocal failed
+        restarts = deque()
+        while not stop.is_set():
+            try: await asyncio.wait_for(stop.wait(), timeout=WORKER_CHECK_INTERVAL)
+            except asyncio.TimeoutError: pass
+            if stop.is_set(): return
+            for i, w in enumerate(workers):
+                if w.is_alive(): continue
+                now = time.monotonic()
+                while restarts and restarts[0] < now - WORKER_RESTART_WINDOW: restarts.popleft()
+                if len(restarts) >= WORKER_MAX_RESTARTS:
+                    logging.error(f"❌ Воркери падають надто часто ({len(restarts)} за {WORKER_RESTART_WINDOW}с), зупиняю фронт")
+                    failed = True
+                    stop.set()
+                    return
+                restarts.append(now)
+                logging.error(f"⚠️ Воркер {i} завершився (код {w.exitcode}), перезапускаю")
+                metrics.inc("bot_webhook_worker_restarts_total", shard=i)
+                workers[i] = start_worker(i)
+
+    async def handle(request):
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=403)
+        data = await request.json()
+        if data.get("update_id") in seen:
+            metrics.inc("bot_webhook_duplicates_total")
+            return web.Response()
+        shard = update_chat_id(data) % len(queues)
+        try: queues[shard].put_nowait(data)
+        except queue.Full:
+            # Telegram повторить доставку пізніше
+            metrics.inc("bot_webhook_rejected_total", shard=shard)
+            return web.Response(status=503)
+        seen.put(data.get("update_id"), True)
+        metrics.inc("bot_webhook_updates_total", shard=shard)
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", WEBHOOK_PORT).start()
+    metrics_runner = await start_metrics_server(METRICS_PORT) if METRICS_PORT else None
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM): loop.add_signal_handler(sig, stop.set)
+    supervisor = asyncio.create_task(supervise())
+    try:
+        await bot.set_webhook(f"{WEBHOOK_URL}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET, allowed_updates=dp.resolve_used_update_types())
+        print(f"🚀 Webhook на :{WEBHOOK_PORT}{WEBHOOK_PATH}, воркерів: {len(workers)}")
+        await stop.wait()
     finally:
-        if db_pool: await db_pool.close(); print("✅ БД закрито.")
+        await runner.cleanup()
+        if metrics_runner: await metrics_runner.cleanup()
+        supervisor.cancel()
+        # put у потоці: повна черга не блокує event loop; воркер, що не прийняв сигнал, буде зупинено
+        async def stop_worker(q, w):
+            try: await loop.run_in_executor(None, lambda: q.put(None, timeout=30))
+            except queue.Full: pass
+            await loop.run_in_executor(None, w.join, 30)
+            if w.is_alive(): w.terminate()
+        await asyncio.gather(*(stop_worker(q, w) for q, w in zip(queues, workers)))
+        await bot.session.close()
+        print("✅ Воркери зупинено.")
+    if failed: raise SystemExit(1)
 
 if __name__ == '__main__':
-    try: asyncio.run(main())
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=["polling", "webhook"], default=os.getenv("BOT_MODE", "polling"))
+    parser.add_argument("--migrate-schema", action="store_true", help="перенести msg_meta/msg_txt у партиціоновані таблиці і вийти")
+    args = parser.parse_args()
+    if args.migrate_schema:
+        asyncio.run(migrate_schema())
+        sys.exit(0)
+    if args.mode == "webhook" and not WEBHOOK_URL:
+        print("❌ ПОМИЛКА: для webhook потрібен WEBHOOK_URL")
+        sys.exit(1)
+    try: asyncio.run(webhook_front() if args.mode == "webhook" else main())
     except KeyboardInterrupt: print("\n🛑 Вимкнено.")
-    except Exception as e: print(f"❌ Error: {e}")
\ No newline at end of file
+    except Exception as e: print(f"❌ Error: {e}")